@@ -0,0 +1,486 @@
+import os
+import re
+import struct
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+from mutagen import File
+
+# Bump when the analysis output changes so every track is analysed again
+ANALYSIS_VERSION = 1
+# ReplayGain 2.0 reference loudness (LUFS)
+REPLAYGAIN_REFERENCE = -18.0
+# Formats whose PCM we decode ourselves; the rest rely on ReplayGain tags
+PCM_EXTENSIONS = ['.wav', '.aiff']
+# Frames decoded per block (bounded memory regardless of file length)
+BLOCK_SECONDS = 30
+# Tracks handed to the pool per database transaction
+BATCH_SIZE = 16
+# Runs that may fail on an unchanged file before it is left alone until it changes
+MAX_ANALYSIS_ATTEMPTS = 3
+
+class UnsupportedAudio(Exception):
+    pass
+
+# ---------------------------------------------------------------------------
+# PCM readers
+# ---------------------------------------------------------------------------
+
+class PCMInfo:
+    def __init__(self, channels, sample_rate, bits, frames, data_offset,
+                 big_endian=False, is_float=False):
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.bits = bits
+        self.frames = frames
+        self.data_offset = data_offset
+        self.big_endian = big_endian
+        self.is_float = is_float
+
+    @property
+    def frame_size(self) -> int:
+        return self.channels * self.bits // 8
+
+def _iter_chunks(f, header_size: int, end: int, big_endian: bool):
+    fmt = '>4sI' if big_endian else '<4sI'
+    pos = header_size
+    while pos + 8 <= end:
+        f.seek(pos)
+        chunk_id, size = struct.unpack(fmt, f.read(8))
+        yield chunk_id, pos + 8, size
+        # Chunks are padded to an even length
+        pos += 8 + size + (size & 1)
+
+def read_wav_info(f) -> PCMInfo:
+    riff, riff_size, wave = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise UnsupportedAudio("Not a RIFF/WAVE file")
+    file_end = os.fstat(f.fileno()).st_size
+    fmt = None
+    for chunk_id, offset, size in _iter_chunks(f, 12, file_end, big_endian=False):
+        if chunk_id == b'fmt ':
+            f.seek(offset)
+            fmt = f.read(size)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise UnsupportedAudio("WAV data chunk before fmt chunk")
+            tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+            if tag == 0xFFFE and len(fmt) >= 26:
+                # WAVE_FORMAT_EXTENSIBLE: the real format is the start of the sub-format GUID
+                tag = struct.unpack('<H', fmt[24:26])[0]
+            if tag not in (1, 3):
+                raise UnsupportedAudio(f"WAV format tag {tag} is not PCM")
+            size = min(size, file_end - offset)
+            frame_size = channels * bits // 8
+            return PCMInfo(channels, sample_rate, bits, size // frame_size, offset,
+                           is_float=(tag == 3))
+    raise UnsupportedAudio("WAV file has no data chunk")
+
+def _extended_to_float(data: bytes) -> float:
+    """Decode the 80-bit IEEE extended float AIFF uses for the sample rate"""
+    exponent, mantissa = struct.unpack('>HQ', data)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent &= 0x7FFF
+    if exponent == 0 and mantissa == 0:
+        return 0.0
+    return sign * mantissa * 2.0 ** (exponent - 16383 - 63)
+
+def read_aiff_info(f) -> PCMInfo:
+    form, form_size, form_type = struct.unpack('>4sI4s', f.read(12))
+    if form != b'FORM' or form_type not in (b'AIFF', b'AIFC'):
+        raise UnsupportedAudio("Not an AIFF file")
+    file_end = os.fstat(f.fileno()).st_size
+    comm = None
+    for chunk_id, offset, size in _iter_chunks(f, 12, file_end, big_endian=True):
+        if chunk_id == b'COMM':
+            f.seek(offset)
+            comm = f.read(size)
+        elif chunk_id == b'SSND':
+            if comm is None:
+                raise UnsupportedAudio("AIFF SSND chunk before COMM chunk")
+            channels, frames, bits = struct.unpack('>hIh', comm[:8])
+            sample_rate = int(round(_extended_to_float(comm[8:18])))
+            big_endian, is_float = True, False
+            if form_type == b'AIFC':
+                compression = comm[18:22]
+                if compression == b'sowt':
+                    big_endian = False
+                elif compression in (b'fl32', b'FL32', b'fl64', b'FL64'):
+                    is_float = True
+                    bits = 64 if compression.lower() == b'fl64' else 32
+                elif compression not in (b'NONE', b'twos'):
+                    raise UnsupportedAudio(f"AIFF-C compression {compression!r} is not supported")
+            f.seek(offset)
+            data_offset = struct.unpack('>I', f.read(4))[0]
+            start = offset + 8 + data_offset
+            frame_size = channels * bits // 8
+            frames = min(frames, (file_end - start) // frame_size)
+            return PCMInfo(channels, sample_rate, bits, frames, start,
+                           big_endian=big_endian, is_float=is_float)
+    raise UnsupportedAudio("AIFF file has no SSND chunk")
+
+def _decode(raw: bytes, info: PCMInfo) -> np.ndarray:
+    """Convert raw interleaved PCM to float32 samples in [-1, 1], shape (frames, channels)"""
+    order = '>' if info.big_endian else '<'
+    if info.is_float:
+        samples = np.frombuffer(raw, dtype=f'{order}f{info.bits // 8}').astype(np.float32)
+    elif info.bits == 8:
+        # 8-bit WAV is unsigned, 8-bit AIFF is signed
+        if info.big_endian:
+            samples = np.frombuffer(raw, dtype=np.int8).astype(np.float32) / 128.0
+        else:
+            samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif info.bits == 24:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        if info.big_endian:
+            b = b[:, ::-1]
+        values = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        values = np.where(values & 0x800000, values - 0x1000000, values)
+        samples = values.astype(np.float32) / 8388608.0
+    elif info.bits in (16, 32):
+        samples = np.frombuffer(raw, dtype=f'{order}i{info.bits // 8}').astype(np.float32)
+        samples /= float(2 ** (info.bits - 1))
+    else:
+        raise UnsupportedAudio(f"{info.bits}-bit PCM is not supported")
+    return samples.reshape(-1, info.channels)
+
+def iter_pcm_blocks(file_path: str, ext: str, block_frames: Optional[int] = None):
+    """Yield (info, block) for a WAV/AIFF file, each block being float32 (frames, channels)"""
+    with open(file_path, 'rb') as f:
+        info = read_aiff_info(f) if ext == '.aiff' else read_wav_info(f)
+        if info.channels <= 0 or info.sample_rate <= 0 or info.frames <= 0:
+            raise UnsupportedAudio("Empty or malformed PCM stream")
+        block_frames = block_frames or info.sample_rate * BLOCK_SECONDS
+        f.seek(info.data_offset)
+        remaining = info.frames
+        while remaining > 0:
+            n = min(block_frames, remaining)
+            raw = f.read(n * info.frame_size)
+            n = len(raw) // info.frame_size
+            if n == 0:
+                break
+            yield info, _decode(raw[:n * info.frame_size], info)
+            remaining -= n
+
+# ---------------------------------------------------------------------------
+# Waveform peaks and loudness
+# ---------------------------------------------------------------------------
+
+def _biquad_response(b, a, freqs: np.ndarray, sample_rate: int) -> np.ndarray:
+    """|H(e^jw)|^2 of a biquad at the given frequencies"""
+    z = np.exp(-1j * 2 * np.pi * freqs / sample_rate)
+    num = b[0] + b[1] * z + b[2] * z * z
+    den = a[0] + a[1] * z + a[2] * z * z
+    return np.abs(num / den) ** 2
+
+def k_weighting(freqs: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Power response of the ITU-R BS.1770 K-weighting filter (shelf + RLB high-pass)"""
+    # High shelf, +4 dB above ~1.5 kHz
+    gain, q, fc = 4.0, 1 / np.sqrt(2), 1500.0
+    A = 10 ** (gain / 40)
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    shelf_b = [A * ((A + 1) + (A - 1) * cos_w0 + 2 * np.sqrt(A) * alpha),
+               -2 * A * ((A - 1) + (A + 1) * cos_w0),
+               A * ((A + 1) + (A - 1) * cos_w0 - 2 * np.sqrt(A) * alpha)]
+    shelf_a = [(A + 1) - (A - 1) * cos_w0 + 2 * np.sqrt(A) * alpha,
+               2 * ((A - 1) - (A + 1) * cos_w0),
+               (A + 1) - (A - 1) * cos_w0 - 2 * np.sqrt(A) * alpha]
+    # High-pass at ~38 Hz
+    q, fc = 0.5, 38.0
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    hp_b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    hp_a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+    return (_biquad_response(shelf_b, shelf_a, freqs, sample_rate)
+            * _biquad_response(hp_b, hp_a, freqs, sample_rate))
+
+class LoudnessMeter:
+    """Integrated loudness (BS.1770 gating) computed from 100 ms sub-blocks
+
+    The K-weighting is applied in the frequency domain: each 100 ms
+    sub-block's mean square is taken from its weighted power spectrum
+    (Parseval), so the whole computation is vectorized over the block. The
+    400 ms gating blocks with 75 % overlap are sums of four sub-blocks.
+    """
+
+    def __init__(self, sample_rate: int, channels: int):
+        self.sub_len = max(1, int(round(sample_rate * 0.1)))
+        freqs = np.fft.rfftfreq(self.sub_len, d=1.0 / sample_rate)
+        weights = np.full(freqs.shape, 2.0)
+        weights[0] = 1.0
+        if self.sub_len % 2 == 0:
+            weights[-1] = 1.0
+        self.spectrum_weights = weights * k_weighting(freqs, sample_rate) / (self.sub_len ** 2)
+        self.channels = channels
+        self.pending = np.zeros((0, channels), dtype=np.float32)
+        self.energies = []
+
+    def add(self, block: np.ndarray):
+        if self.pending.size:
+            block = np.concatenate([self.pending, block])
+        usable = (len(block) // self.sub_len) * self.sub_len
+        self.pending = block[usable:]
+        if usable == 0:
+            return
+        # (sub_blocks, sub_len, channels) -> spectrum along the time axis
+        sub = block[:usable].reshape(-1, self.sub_len, self.channels)
+        spectrum = np.fft.rfft(sub, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        self.energies.append(np.einsum('skc,k->sc', power, self.spectrum_weights))
+
+    def integrated(self) -> Optional[float]:
+        if not self.energies:
+            return None
+        sub = np.concatenate(self.energies).sum(axis=1)
+        if len(sub) < 4:
+            return None
+        # Mean square of each 400 ms block (four consecutive 100 ms sub-blocks)
+        cumulative = np.concatenate([[0.0], np.cumsum(sub)])
+        blocks = (cumulative[4:] - cumulative[:-4]) / 4
+        with np.errstate(divide='ignore'):
+            loudness = -0.691 + 10 * np.log10(blocks)
+        gated = blocks[loudness > -70.0]
+        if gated.size == 0:
+            return None
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) - 10.0
+        gated = blocks[(loudness > -70.0) & (loudness > relative_gate)]
+        if gated.size == 0:
+            return None
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+def analyze_pcm(file_path: str, ext: str, points: int) -> dict:
+    peaks = np.zeros(points, dtype=np.float32)
+    meter = None
+    sample_peak = 0.0
+    position = 0
+    for info, block in iter_pcm_blocks(file_path, ext):
+        if meter is None:
+            meter = LoudnessMeter(info.sample_rate, info.channels)
+        amplitude = np.abs(block).max(axis=1)
+        # Bucket every frame, then take the max per bucket with one reduceat
+        buckets = (np.arange(position, position + len(block), dtype=np.int64) * points) // info.frames
+        buckets = np.minimum(buckets, points - 1)
+        starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+        block_peaks = np.maximum.reduceat(amplitude, starts)
+        indices = buckets[starts]
+        peaks[indices] = np.maximum(peaks[indices], block_peaks)
+        sample_peak = max(sample_peak, float(amplitude.max()))
+        meter.add(block)
+        position += len(block)
+
+    loudness = meter.integrated() if meter else None
+    return {
+        'status': 'pcm',
+        'loudness': loudness,
+        'track_gain': None if loudness is None else REPLAYGAIN_REFERENCE - loudness,
+        'track_peak': sample_peak,
+        'album_gain': None,
+        'album_peak': None,
+        'peaks': np.round(np.clip(peaks, 0.0, 1.0) * 255).astype(np.uint8).tobytes(),
+    }
+
+_REPLAYGAIN_KEYS = {
+    'replaygain_track_gain': 'track_gain',
+    'replaygain_track_peak': 'track_peak',
+    'replaygain_album_gain': 'album_gain',
+    'replaygain_album_peak': 'album_peak',
+}
+_NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?')
+
+def _tag_text(value) -> str:
+    if isinstance(value, list):
+        value = value[0] if value else ''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    # ID3 frames and APE values stringify to their text
+    return str(value)
+
+def read_replaygain_tags(file_path: str) -> dict:
+    """ReplayGain values from ID3 TXXX, Vorbis/APE comments or MP4 freeform atoms"""
+    result = {}
+    audio = File(file_path)
+    if audio is None or not audio.tags:
+        return result
+    for key, value in audio.tags.items():
+        name = key.lower()
+        for prefix in ('txxx:', '----:com.apple.itunes:'):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        field = _REPLAYGAIN_KEYS.get(name)
+        if field is None:
+            continue
+        match = _NUMBER.search(_tag_text(value))
+        if match:
+            result[field] = float(match.group())
+    return result
+
+def analyze_file(file_path: str, ext: str, points: int) -> dict:
+    """Analyse one file; runs in a worker process so it must stay picklable"""
+    try:
+        if ext in PCM_EXTENSIONS:
+            try:
+                return analyze_pcm(file_path, ext, points)
+            except UnsupportedAudio:
+                pass
+        tags = read_replaygain_tags(file_path)
+        result = {
+            'status': 'tags' if tags else 'unavailable',
+            'loudness': None,
+            'track_gain': None,
+            'track_peak': None,
+            'album_gain': None,
+            'album_peak': None,
+            'peaks': None,
+        }
+        result.update(tags)
+        if result['track_gain'] is not None:
+            result['loudness'] = REPLAYGAIN_REFERENCE - result['track_gain']
+        return result
+    except Exception as e:
+        return {'status': 'error', 'error': str(e)}
+
+def decode_peaks(data: bytes, points: Optional[int] = None) -> list:
+    """Stored uint8 peaks -> floats in [0, 1], optionally max-pooled down to `points`"""
+    peaks = np.frombuffer(data, dtype=np.uint8).astype(np.float32) / 255.0
+    if points and 0 < points < len(peaks):
+        edges = (np.arange(points) * len(peaks)) // points
+        peaks = np.maximum.reduceat(peaks, edges)
+    return [round(float(p), 3) for p in peaks]
+
+# ---------------------------------------------------------------------------
+# Background runner
+# ---------------------------------------------------------------------------
+
+class AnalysisRunner:
+    """Analyses new and changed tracks in a process pool after each scan
+
+    Runs in a daemon thread so startup and browsing never wait for it; the
+    database is written in small per-batch transactions. `on_complete` is
+    called when a run stored new results.
+    """
+
+    def __init__(self, session_factory, workers: int, points: int,
+                 on_complete: Optional[Callable[[], None]] = None):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.points = points
+        self.on_complete = on_complete
+        self._thread = None
+        self._rerun = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start a run, or queue another one if a run is in progress"""
+        if self.workers <= 0:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                self._rerun.set()
+                return
+            self._thread = threading.Thread(target=self._run, name="audio-analysis", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from .worker_sync import file_lock
+        while True:
+            self._rerun.clear()
+            with file_lock("analysis", blocking=False) as leader:
+                if not leader:
+                    return
+                try:
+                    stored = self._analyze_pending()
+                except Exception as e:
+                    print(f"Audio analysis failed: {e}")
+                    stored = 0
+            if stored and self.on_complete:
+                self.on_complete()
+            if not self._rerun.is_set():
+                return
+
+    def _pending_tracks(self) -> list:
+        from . import models
+        db = self.session_factory()
+        try:
+            rows = db.query(
+                models.Track.id, models.Track.file_path, models.TrackAnalysis.file_size,
+                models.TrackAnalysis.file_mtime, models.TrackAnalysis.version, models.TrackAnalysis.status,
+                models.TrackAnalysis.attempts
+            ).outerjoin(models.TrackAnalysis, models.TrackAnalysis.track_id == models.Track.id).all()
+        finally:
+            db.close()
+        pending = []
+        for track_id, file_path, size, mtime, version, status, attempts in rows:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            # Errors may be transient (I/O, file still being copied), so retry them a few
+            # times; a file that keeps failing is only analysed again once it changes
+            if (version != ANALYSIS_VERSION or size != stat.st_size or mtime != stat.st_mtime
+                    or (status == 'error' and (attempts or 0) < MAX_ANALYSIS_ATTEMPTS)):
+                pending.append((track_id, file_path, stat.st_size, stat.st_mtime))
+        return pending
+
+    def _analyze_pending(self) -> int:
+        from . import models
+        pending = self._pending_tracks()
+        if not pending:
+            return 0
+        print(f"Analysing {len(pending)} tracks")
+        stored = 0
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = pending[i:i + BATCH_SIZE]
+                results = pool.map(analyze_file,
+                                   [path for _, path, _, _ in batch],
+                                   [os.path.splitext(path)[1].lower() for _, path, _, _ in batch],
+                                   [self.points] * len(batch))
+                results = list(results)
+                db = self.session_factory()
+                try:
+                    for (track_id, file_path, size, mtime), result in zip(batch, results):
+                        if result.get('status') == 'error':
+                            print(f"Error analysing file {file_path}: {result.get('error')}")
+                        analysis = db.query(models.TrackAnalysis).filter(
+                            models.TrackAnalysis.track_id == track_id
+                        ).first()
+                        if analysis is None:
+                            analysis = models.TrackAnalysis(track_id=track_id)
+                            db.add(analysis)
+                        if result.get('status') != 'error':
+                            analysis.attempts = 0
+                        elif (analysis.status == 'error' and analysis.file_size == size
+                                and analysis.file_mtime == mtime):
+                            analysis.attempts = (analysis.attempts or 0) + 1
+                        else:
+                            analysis.attempts = 1
+                        analysis.version = ANALYSIS_VERSION
+                        analysis.file_size = size
+                        analysis.file_mtime = mtime
+                        analysis.status = result.get('status')
+                        analysis.loudness = result.get('loudness')
+                        analysis.track_gain = result.get('track_gain')
+                        analysis.track_peak = result.get('track_peak')
+                        analysis.album_gain = result.get('album_gain')
+                        analysis.album_peak = result.get('album_peak')
+                        analysis.peaks = result.get('peaks')
+                        analysis.analyzed_at = time.time()
+                    db.commit()
+                    # Failures add nothing to show, so they don't count as new results
+                    stored += sum(1 for result in results if result.get('status') != 'error')
+                except Exception as e:
+                    # The track may have been removed by a scan in the meantime
+                    db.rollback()
+                    print(f"Error storing analysis results: {e}")
+                finally:
+                    db.close()
+        print(f"Audio analysis completed: {stored} tracks")
+        return stored
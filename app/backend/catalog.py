@@ -0,0 +1,657 @@
+import math
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select
+from . import models
+from .worker_sync import GENERATION_CHECK_INTERVAL, play_log_position, read_plays
+
+# Sentinels for missing values in typed columns
+NO_ID = -1
+NO_NUMBER = float("nan")
+# Upper bound used to turn a prefix into a range (same trick as crud._prefix_filter)
+PREFIX_END = "\U0010ffff"
+# Rows fetched per round-trip while building
+BUILD_BATCH_SIZE = 5000
+# Seconds to wait before retrying a failed build
+REBUILD_RETRY_SECONDS = 30
+# A filter range holding more than this share of the rows is walked in sort
+# order and filtered lazily instead of being copied and re-sorted
+SELECTIVE_FRACTION = 0.05
+
+
+def _null_key(value):
+    """Sort key placing NULLs first, like SQLite does for ascending order"""
+    if value is None:
+        return (0, 0)
+    return (1, value)
+
+
+class StringTable:
+    """Interned strings referenced by a small integer index"""
+
+    __slots__ = ("values", "_index")
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_ID
+        index = self._index.get(value)
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            self._index[value] = index
+        return index
+
+    def get(self, index: int) -> Optional[str]:
+        return None if index == NO_ID else self.values[index]
+
+    def find(self, value: str) -> int:
+        return self._index.get(value, NO_ID)
+
+    def nbytes(self) -> int:
+        return (sys.getsizeof(self.values) + sys.getsizeof(self._index)
+                + sum(sys.getsizeof(v) for v in self.values))
+
+
+class TextColumn:
+    """Unique strings packed as UTF-8 into one buffer with an offsets array"""
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("I", [0])
+
+    def append(self, value: Optional[str]):
+        if value:
+            self.data += value.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, position: int) -> str:
+        return self.data[self.offsets[position]:self.offsets[position + 1]].decode("utf-8")
+
+    def trim(self):
+        self.data = bytearray(self.data)
+        self.offsets = self.offsets[:]
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.data) + sys.getsizeof(self.offsets)
+
+
+class SortedIndex:
+    """Row positions ordered by (key, id), searchable with bisect"""
+
+    __slots__ = ("positions", "key", "ids")
+
+    def __init__(self, count: int, key: Callable[[int], object], ids: array):
+        self.key = lambda p: _null_key(key(p))
+        self.ids = ids
+        self.positions = array("i", sorted(range(count), key=self._order))
+
+    def _order(self, position: int):
+        return self.key(position), self.ids[position]
+
+    def find(self, positions: array, position: int) -> int:
+        """Where `position` is (or belongs) in `positions`, by its current key"""
+        return bisect_left(positions, self._order(position), key=self._order)
+
+    def range(self, low=None, high=None, include_high: bool = True) -> array:
+        positions = self.positions
+        start = 0 if low is None else bisect_left(positions, _null_key(low), key=self.key)
+        if high is None:
+            end = len(positions)
+        elif include_high:
+            end = bisect_right(positions, _null_key(high), key=self.key)
+        else:
+            end = bisect_left(positions, _null_key(high), key=self.key)
+        return positions[start:end]
+
+    def equal(self, value) -> array:
+        return self.range(value, value)
+
+
+class TrackRow:
+    """One track as read from the columns, only materialized for returned rows
+
+    file_path, bitrate, sample_rate and file_size are only displayed, never
+    sorted or filtered on, so they are loaded per page from the database.
+    """
+
+    __slots__ = ("id", "title", "artist_id", "album_id", "file_path", "file_type",
+                 "duration", "bitrate", "sample_rate", "file_size", "duplicate_of",
+                 "play_count", "added_at")
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _number(value):
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+def _int_or_none(value):
+    return None if value == NO_ID else value
+
+
+class CatalogSnapshot:
+    """Read-only, array-backed copy of the track/artist/album tables
+
+    Tracks are stored column by column in typed arrays, only for the fields
+    listings sort or filter on; artist names, album titles and file types
+    are interned and titles are packed UTF-8. Sorted indexes are built lazily
+    per sort field and cached for the life of the snapshot. Play counts
+    recorded after the build are applied from the shared play log.
+    """
+
+    TRACK_SORT_FIELDS = ("id", "title", "duration", "file_type", "play_count",
+                         "added_at", "artist", "album")
+    ALBUM_SORT_FIELDS = ("id", "title", "artist")
+    ARTIST_SORT_FIELDS = ("id", "name")
+
+    def __init__(self, generation: Optional[int]):
+        self.generation = generation
+        self.built_at = time.time()
+        self.build_seconds = 0.0
+        self._indexes: Dict[str, SortedIndex] = {}
+        self._lock = threading.Lock()
+        # Play log read position; set before the database is read so no play is missed
+        self.play_log_position = (0, 0)
+        self._plays_checked = 0.0
+
+        # Tracks
+        self.ids = array("i")
+        self.titles = TextColumn()
+        self.artist_ids = array("i")
+        self.album_ids = array("i")
+        self.file_types = StringTable()
+        self.file_type_index = array("b")
+        self.durations = array("d")
+        self.duplicate_of = array("i")
+        self.play_counts = array("i")
+        self.added_at = array("d")
+
+        # Artists and albums (ids ascending, looked up with bisect)
+        self.artist_row_ids = array("i")
+        self.artist_names = StringTable()
+        self.artist_name_index = array("i")
+        self.album_row_ids = array("i")
+        self.album_titles = StringTable()
+        self.album_title_index = array("i")
+        self.album_artist_ids = array("i")
+        self.album_covers: Dict[int, str] = {}  # sparse: most albums have no cover
+
+    # -- building -----------------------------------------------------------
+
+    @classmethod
+    def build(cls, db, generation: Optional[int]) -> "CatalogSnapshot":
+        started = time.monotonic()
+        snapshot = cls(generation)
+        snapshot.play_log_position = play_log_position()
+
+        artists = select(models.Artist.id, models.Artist.name).order_by(models.Artist.id)
+        for artist_id, name in db.execute(artists.execution_options(yield_per=BUILD_BATCH_SIZE)):
+            snapshot.artist_row_ids.append(artist_id)
+            snapshot.artist_name_index.append(snapshot.artist_names.add(name))
+
+        albums = select(
+            models.Album.id, models.Album.title, models.Album.artist_id, models.Album.cover_path
+        ).order_by(models.Album.id)
+        for album_id, title, artist_id, cover_path in db.execute(albums.execution_options(yield_per=BUILD_BATCH_SIZE)):
+            if cover_path:
+                snapshot.album_covers[len(snapshot.album_row_ids)] = cover_path
+            snapshot.album_row_ids.append(album_id)
+            snapshot.album_title_index.append(snapshot.album_titles.add(title))
+            snapshot.album_artist_ids.append(NO_ID if artist_id is None else artist_id)
+
+        tracks = select(
+            models.Track.id, models.Track.title, models.Track.artist_id, models.Track.album_id,
+            models.Track.file_type, models.Track.duration, models.Track.duplicate_of,
+            models.Track.play_count, models.Track.added_at,
+        ).order_by(models.Track.id)
+        for row in db.execute(tracks.execution_options(yield_per=BUILD_BATCH_SIZE)):
+            snapshot._append_track(*row)
+
+        snapshot._trim()
+        snapshot.build_seconds = time.monotonic() - started
+        return snapshot
+
+    def _append_track(self, track_id, title, artist_id, album_id, file_type, duration,
+                      duplicate_of, play_count, added_at):
+        self.ids.append(track_id)
+        self.titles.append(title)
+        self.artist_ids.append(NO_ID if artist_id is None else artist_id)
+        self.album_ids.append(NO_ID if album_id is None else album_id)
+        self.file_type_index.append(self.file_types.add(file_type))
+        self.durations.append(NO_NUMBER if duration is None else duration)
+        self.duplicate_of.append(NO_ID if duplicate_of is None else duplicate_of)
+        self.play_counts.append(NO_ID if play_count is None else play_count)
+        self.added_at.append(NO_NUMBER if added_at is None else added_at)
+
+    def _trim(self):
+        """Drop the spare capacity arrays keep after being appended to"""
+        for name, value in list(vars(self).items()):
+            if isinstance(value, array):
+                setattr(self, name, value[:])
+            elif isinstance(value, TextColumn):
+                value.trim()
+
+    # -- lookups --------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def _position(ids: array, row_id: int) -> Optional[int]:
+        position = bisect_left(ids, row_id)
+        if position < len(ids) and ids[position] == row_id:
+            return position
+        return None
+
+    def artist_name(self, artist_id: int) -> Optional[str]:
+        position = self._position(self.artist_row_ids, artist_id)
+        return None if position is None else self.artist_names.get(self.artist_name_index[position])
+
+    def album_title(self, album_id: int) -> Optional[str]:
+        position = self._position(self.album_row_ids, album_id)
+        return None if position is None else self.album_titles.get(self.album_title_index[position])
+
+    def track(self, position: int, files) -> TrackRow:
+        """`files` is the track's (file_path, bitrate, sample_rate, file_size) row"""
+        row = TrackRow()
+        row.id = self.ids[position]
+        row.title = self.titles[position]
+        row.artist_id = _int_or_none(self.artist_ids[position])
+        row.album_id = _int_or_none(self.album_ids[position])
+        row.file_path = files.file_path
+        row.file_type = self.file_types.get(self.file_type_index[position])
+        row.duration = _number(self.durations[position])
+        row.bitrate = files.bitrate
+        row.sample_rate = files.sample_rate
+        row.file_size = files.file_size
+        row.duplicate_of = _int_or_none(self.duplicate_of[position])
+        row.play_count = _int_or_none(self.play_counts[position])
+        row.added_at = _number(self.added_at[position])
+        return row
+
+    def artist_dict(self, artist_id: Optional[int]) -> Optional[dict]:
+        if artist_id is None:
+            return None
+        name = self.artist_name(artist_id)
+        return None if name is None else {"id": artist_id, "name": name}
+
+    def artist_id_by_name(self, name: str) -> Optional[int]:
+        # Artist names are unique, so the name resolves to at most one id
+        name_index = self.artist_names.find(name)
+        if name_index == NO_ID:
+            return None
+        position = self.artist_name_index.index(name_index)
+        return self.artist_row_ids[position]
+
+    def album_dict(self, album_id: Optional[int]) -> Optional[dict]:
+        if album_id is None:
+            return None
+        position = self._position(self.album_row_ids, album_id)
+        return None if position is None else self._album_at(position)
+
+    def _album_at(self, position: int) -> dict:
+        return {
+            "id": self.album_row_ids[position],
+            "title": self.album_titles.get(self.album_title_index[position]),
+            "artist_id": _int_or_none(self.album_artist_ids[position]),
+            "cover_path": self.album_covers.get(position),
+        }
+
+    def track_dicts(self, positions, files: dict, lyrics: dict, analyses: dict) -> List[dict]:
+        """TrackWithDetails-shaped dicts; files/lyrics/analyses are keyed by track id
+
+        Tracks missing from `files` were deleted after the snapshot was built
+        and are left out.
+        """
+        rows = []
+        for position in positions:
+            track_files = files.get(self.ids[position])
+            if track_files is None:
+                continue
+            row = self.track(position, track_files).as_dict()
+            row["artist"] = self.artist_dict(row["artist_id"])
+            row["album"] = self.album_dict(row["album_id"])
+            row["lyric"] = lyrics.get(row["id"])
+            row["analysis"] = analyses.get(row["id"])
+            rows.append(row)
+        return rows
+
+    # -- indexes ----------------------------------------------------------------
+
+    def _track_key(self, field: str) -> Callable[[int], object]:
+        if field == "id":
+            return self.ids.__getitem__
+        if field == "title":
+            return self.titles.__getitem__
+        if field == "duration":
+            return lambda p: _number(self.durations[p])
+        if field == "file_type":
+            return lambda p: self.file_types.get(self.file_type_index[p])
+        if field == "play_count":
+            return lambda p: _int_or_none(self.play_counts[p])
+        if field == "added_at":
+            return lambda p: _number(self.added_at[p])
+        if field == "artist":
+            return lambda p: self.artist_name(self.artist_ids[p])
+        if field == "album":
+            return lambda p: self.album_title(self.album_ids[p])
+        if field == "artist_id":
+            return lambda p: _int_or_none(self.artist_ids[p])
+        if field == "album_id":
+            return lambda p: _int_or_none(self.album_ids[p])
+        raise ValueError(f"Unknown sort field: {field!r}")
+
+    def _album_key(self, field: str) -> Callable[[int], object]:
+        if field == "id":
+            return self.album_row_ids.__getitem__
+        if field == "title":
+            return lambda p: self.album_titles.get(self.album_title_index[p])
+        if field == "artist":
+            return lambda p: self.artist_name(self.album_artist_ids[p])
+        if field == "artist_id":
+            return lambda p: _int_or_none(self.album_artist_ids[p])
+        raise ValueError(f"Unknown sort field: {field!r}")
+
+    def _artist_key(self, field: str) -> Callable[[int], object]:
+        if field == "id":
+            return self.artist_row_ids.__getitem__
+        if field == "name":
+            return lambda p: self.artist_names.get(self.artist_name_index[p])
+        raise ValueError(f"Unknown sort field: {field!r}")
+
+    def _cached_index(self, name: str, build: Callable[[], SortedIndex]) -> SortedIndex:
+        index = self._indexes.get(name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(name)
+                if index is None:
+                    index = build()
+                    self._indexes[name] = index
+        return index
+
+    def index(self, field: str) -> SortedIndex:
+        return self._cached_index(field, lambda: SortedIndex(len(self), self._track_key(field), self.ids))
+
+    def album_index(self, field: str) -> SortedIndex:
+        return self._cached_index(f"albums.{field}", lambda: SortedIndex(
+            len(self.album_row_ids), self._album_key(field), self.album_row_ids))
+
+    def artist_index(self, field: str) -> SortedIndex:
+        return self._cached_index(f"artists.{field}", lambda: SortedIndex(
+            len(self.artist_row_ids), self._artist_key(field), self.artist_row_ids))
+
+    def catch_up_plays(self):
+        """Apply play counts recorded (by any worker) since the last check
+
+        Checked at most once per GENERATION_CHECK_INTERVAL. Log records hold
+        absolute counts, so records already included in the build are no-ops.
+        The play_count index is updated in place of being rebuilt; readers
+        keep walking the copy they started with.
+        """
+        now = time.monotonic()
+        if now - self._plays_checked < GENERATION_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if now - self._plays_checked < GENERATION_CHECK_INTERVAL:
+                return
+            self._plays_checked = now
+            self.play_log_position, plays = read_plays(self.play_log_position)
+            if not plays:
+                return
+            index = self._indexes.get("play_count")
+            positions = None if index is None else index.positions[:]
+            for track_id, play_count in plays:
+                position = self._position(self.ids, track_id)
+                if position is None or play_count <= self.play_counts[position]:
+                    continue
+                # Take the row out under its old count and put it back under the new one
+                if positions is not None:
+                    del positions[index.find(positions, position)]
+                self.play_counts[position] = play_count
+                if positions is not None:
+                    positions.insert(index.find(positions, position), position)
+            if positions is not None:
+                index.positions = positions
+
+    # -- queries ----------------------------------------------------------------
+
+    @staticmethod
+    def _ordered(key: str, descending: bool, count: int, ids: array, ranges: list, checks: list,
+                 sort_index: Callable[[str], SortedIndex], sort_key: Callable[[str], Callable[[int], object]]):
+        """Positions passing every check in (key, id) order, as an iterator
+
+        `ranges` holds (field, positions) candidates taken from sorted indexes.
+        A selective range is copied, filtered and sorted; otherwise the sort
+        order is walked and filtered lazily, so the caller's slice stops
+        after offset + limit matches.
+        """
+        def matches(p: int) -> bool:
+            return all(check(p) for check in checks)
+
+        narrowest = min(ranges, key=lambda r: len(r[1]), default=None)
+        if narrowest is not None and narrowest[0] == key:
+            # Range of the sort index itself: already in order
+            order = narrowest[1]
+        elif narrowest is not None and len(narrowest[1]) <= count * SELECTIVE_FRACTION:
+            candidates = [p for p in narrowest[1] if matches(p)]
+            row_key = sort_key(key)
+            candidates.sort(key=lambda p: (_null_key(row_key(p)), ids[p]), reverse=descending)
+            return iter(candidates)
+        else:
+            order = range(count) if key == "id" else sort_index(key).positions
+        if descending:
+            order = reversed(order)
+        return (p for p in order if matches(p))
+
+    def query_tracks(self, sort: str = "id", hide_duplicates: bool = False,
+                     artist_id: Optional[int] = None, album_id: Optional[int] = None,
+                     artist: Optional[str] = None, album: Optional[str] = None,
+                     file_type: Optional[str] = None, min_duration: Optional[float] = None,
+                     max_duration: Optional[float] = None, title_prefix: Optional[str] = None):
+        """Positions of matching tracks in order, mirroring crud.query_tracks
+
+        Returns an iterator; the caller slices it, so an unfiltered listing
+        only touches offset + limit rows.
+        """
+        descending = sort.startswith("-")
+        key = sort.lstrip("-")
+        if key not in self.TRACK_SORT_FIELDS:
+            raise ValueError(f"Unknown sort field: {key!r}")
+
+        ranges = []
+        checks = []
+        if artist is not None:
+            found = self.artist_id_by_name(artist)
+            if found is None or (artist_id is not None and artist_id != found):
+                return iter(())
+            artist_id = found
+        if artist_id is not None:
+            ranges.append(("artist_id", self.index("artist_id").equal(artist_id)))
+            checks.append(lambda p: self.artist_ids[p] == artist_id)
+        if album is not None:
+            title_index = self.album_titles.find(album)
+            album_id_set = {a for a, t in zip(self.album_row_ids, self.album_title_index)
+                            if t == title_index and title_index != NO_ID}
+            if not album_id_set:
+                return iter(())
+            checks.append(lambda p: self.album_ids[p] in album_id_set)
+        if album_id is not None:
+            ranges.append(("album_id", self.index("album_id").equal(album_id)))
+            checks.append(lambda p: self.album_ids[p] == album_id)
+        if file_type is not None:
+            file_type = file_type.lower().lstrip(".")
+            ranges.append(("file_type", self.index("file_type").equal(file_type)))
+            type_index = self.file_types.find(file_type)
+            checks.append(lambda p: self.file_type_index[p] == type_index)
+        if min_duration is not None or max_duration is not None:
+            ranges.append(("duration", self.index("duration").range(min_duration, max_duration)))
+            if min_duration is not None:
+                checks.append(lambda p: self.durations[p] >= min_duration)
+            if max_duration is not None:
+                checks.append(lambda p: self.durations[p] <= max_duration)
+        if title_prefix:
+            ranges.append(("title", self.index("title").range(
+                title_prefix, title_prefix + PREFIX_END, include_high=False)))
+            checks.append(lambda p: self.titles[p].startswith(title_prefix))
+        if hide_duplicates:
+            checks.append(lambda p: self.duplicate_of[p] == NO_ID)
+
+        return self._ordered(key, descending, len(self), self.ids, ranges, checks,
+                             self.index, self._track_key)
+
+    def list_albums(self, sort: str = "id", artist_id: Optional[int] = None,
+                    artist: Optional[str] = None, title_prefix: Optional[str] = None):
+        """Album dicts in order, mirroring crud.query_albums; an iterator like query_tracks"""
+        descending = sort.startswith("-")
+        key = sort.lstrip("-")
+        if key not in self.ALBUM_SORT_FIELDS:
+            raise ValueError(f"Unknown sort field: {key!r}")
+
+        ranges = []
+        checks = []
+        if artist is not None:
+            found = self.artist_id_by_name(artist)
+            if found is None or (artist_id is not None and artist_id != found):
+                return iter(())
+            artist_id = found
+        if artist_id is not None:
+            ranges.append(("artist_id", self.album_index("artist_id").equal(artist_id)))
+            checks.append(lambda p: self.album_artist_ids[p] == artist_id)
+        if title_prefix:
+            ranges.append(("title", self.album_index("title").range(
+                title_prefix, title_prefix + PREFIX_END, include_high=False)))
+            checks.append(lambda p: (self.album_titles.get(self.album_title_index[p]) or "").startswith(title_prefix))
+
+        positions = self._ordered(key, descending, len(self.album_row_ids), self.album_row_ids,
+                                  ranges, checks, self.album_index, self._album_key)
+        return (self._album_at(p) for p in positions)
+
+    def list_artists(self, sort: str = "id", name_prefix: Optional[str] = None):
+        """Artist dicts in order, mirroring crud.query_artists; an iterator like query_tracks"""
+        descending = sort.startswith("-")
+        key = sort.lstrip("-")
+        if key not in self.ARTIST_SORT_FIELDS:
+            raise ValueError(f"Unknown sort field: {key!r}")
+
+        ranges = []
+        checks = []
+        if name_prefix:
+            ranges.append(("name", self.artist_index("name").range(
+                name_prefix, name_prefix + PREFIX_END, include_high=False)))
+            checks.append(lambda p: (self.artist_names.get(self.artist_name_index[p]) or "").startswith(name_prefix))
+
+        positions = self._ordered(key, descending, len(self.artist_row_ids), self.artist_row_ids,
+                                  ranges, checks, self.artist_index, self._artist_key)
+        return ({"id": self.artist_row_ids[p], "name": self.artist_names.get(self.artist_name_index[p])}
+                for p in positions)
+
+    # -- accounting ---------------------------------------------------------
+
+    def memory_usage(self) -> dict:
+        """Allocated sizes (including spare capacity and object headers) of everything held"""
+        columns = [self.ids, self.artist_ids, self.album_ids, self.file_type_index, self.durations,
+                   self.duplicate_of, self.play_counts, self.added_at]
+        track_bytes = (sum(sys.getsizeof(c) for c in columns)
+                       + self.titles.nbytes() + self.file_types.nbytes())
+        album_bytes = (sum(sys.getsizeof(c) for c in (self.album_row_ids, self.album_title_index, self.album_artist_ids))
+                       + self.album_titles.nbytes() + sys.getsizeof(self.album_covers)
+                       + sum(sys.getsizeof(c) for c in self.album_covers.values()))
+        artist_bytes = (sum(sys.getsizeof(c) for c in (self.artist_row_ids, self.artist_name_index))
+                        + self.artist_names.nbytes())
+        index_bytes = sum(sys.getsizeof(i.positions) for i in list(self._indexes.values()))
+        total = track_bytes + album_bytes + artist_bytes + index_bytes
+        return {
+            "tracks": len(self),
+            "track_bytes": track_bytes,
+            "album_bytes": album_bytes,
+            "artist_bytes": artist_bytes,
+            "index_bytes": index_bytes,
+            "bytes_per_track": total / len(self) if len(self) else 0,
+        }
+
+
+class Catalog:
+    """Holds the current snapshot and rebuilds it when the library generation changes
+
+    Rebuilds run in a background thread and replace the snapshot with a
+    single reference assignment, so readers always see a complete one.
+    """
+
+    def __init__(self, session_factory, enabled: bool = True):
+        self.session_factory = session_factory
+        self.enabled = enabled
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self._wanted_generation = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._failed_at = 0.0
+
+    def current(self, generation: Optional[int]) -> Optional[CatalogSnapshot]:
+        """The snapshot if it matches `generation`, otherwise None (use the database)"""
+        snapshot = self.snapshot
+        if not self.enabled:
+            return None
+        if snapshot is None or snapshot.generation != generation:
+            self.schedule_rebuild(generation)
+            return None
+        snapshot.catch_up_plays()
+        return snapshot
+
+    def schedule_rebuild(self, generation: Optional[int]):
+        if not self.enabled:
+            return
+        if time.monotonic() - self._failed_at < REBUILD_RETRY_SECONDS:
+            return
+        with self._lock:
+            self._wanted_generation = generation
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._rebuild_loop, name="catalog-rebuild", daemon=True)
+            self._thread.start()
+
+    def _rebuild_loop(self):
+        while True:
+            generation = self._wanted_generation
+            db = self.session_factory()
+            try:
+                snapshot = CatalogSnapshot.build(db, generation)
+            except Exception as e:
+                print(f"Error building catalog snapshot: {e}")
+                snapshot = None
+                self._failed_at = time.monotonic()
+            finally:
+                db.close()
+            with self._lock:
+                if snapshot is not None:
+                    self.snapshot = snapshot
+                    usage = snapshot.memory_usage()
+                    print(f"Catalog snapshot built: {usage['tracks']} tracks, "
+                          f"{usage['bytes_per_track']:.0f} bytes/track, {snapshot.build_seconds:.2f}s")
+                if snapshot is None or self._wanted_generation == generation:
+                    self._thread = None
+                    return
+
+    def status(self) -> dict:
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"enabled": self.enabled, "generation": None}
+        return {
+            "enabled": self.enabled,
+            "generation": snapshot.generation,
+            "built_at": snapshot.built_at,
+            "build_seconds": snapshot.build_seconds,
+            "indexes": sorted(snapshot._indexes),
+            **snapshot.memory_usage(),
+        }
@@ -1,11 +1,41 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, Optional
 
 class Settings(BaseSettings):
     music_dir: str = "./musics"
     host: str = "0.0.0.0"
     port: int = 18000
     database_url: str = "sqlite:///./music.db"
+    # Seconds a SQLite connection waits for a lock held by another worker
+    sqlite_busy_timeout: int = 30
+    # Shared directory for worker lock/generation files (defaults to the database directory)
+    runtime_dir: str = ""
+    # Background audio analysis (0 workers disables it)
+    analysis_workers: int = 2
+    waveform_points: int = 1000
+    # Serve listings from an in-memory snapshot rebuilt after each library change
+    catalog_enabled: bool = False
+    # Query profiling: per-request query counts in X-Query-* headers and /api/admin/queries
+    profile_queries: bool = False
+    # A SELECT repeated this many times in one request is reported as a likely N+1
+    profile_n_plus_one_threshold: int = 5
+    # With profiling on, fail requests (500) that run more queries than this (0 = no budget);
+    # per-route overrides as JSON, e.g. QUERY_BUDGETS='{"/api/tracks": 5}'
+    query_budget: int = 0
+    query_budgets: Dict[str, int] = {}
+    # Database maintenance (orphan cleanup, ANALYZE, incremental vacuum); 0 hours disables it
+    maintenance_interval_hours: float = 24
+    maintenance_batch_size: int = 500
+    # Target longest write transaction per batch, so API writes never wait long
+    maintenance_max_lock_ms: int = 50
+    # Number of uvicorn worker processes (uvicorn reads WEB_CONCURRENCY too);
+    # STREAM_MAX_CONCURRENT and STREAM_UPLINK_RATE are split between them
+    web_concurrency: int = 1
+    # Stream scheduler (0 = unlimited), rates in bytes per second
+    stream_max_concurrent: int = 0
+    stream_client_rate: int = 0
+    stream_client_burst: int = 4 * 1024 * 1024
+    stream_uplink_rate: int = 0
     
     class Config:
         env_file = ".env"
@@ -1,6 +1,91 @@
-from sqlalchemy.orm import Session
+import json
+from typing import Optional
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session, joinedload, selectinload
 from . import models, schemas
 
+# Listing helpers
+def _apply_sort(query, sort: str, sort_columns: dict, tie_breaker):
+    """Order by `sort` ("field" or "-field" for descending), then by id
+
+    Raises ValueError for unknown fields. Each sortable column is backed by
+    an index whose implicit rowid suffix also covers the id tie-breaker.
+    """
+    descending = sort.startswith("-")
+    key = sort.lstrip("-")
+    if key not in sort_columns:
+        raise ValueError(f"Unknown sort field: {key!r}")
+    column = sort_columns[key]
+    if descending:
+        return query.order_by(column.desc(), tie_breaker.desc())
+    return query.order_by(column, tie_breaker)
+
+def _prefix_filter(column, prefix: str):
+    # A range instead of LIKE so SQLite can use the column's index
+    return (column >= prefix) & (column < prefix + "\U0010ffff")
+
+def _artist_id_by_name(db: Session, name: str):
+    # Names are unique: with "=" instead of IN SQLite knows it is one id and searches the index
+    return db.query(models.Artist.id).filter(models.Artist.name == name).scalar_subquery()
+
+def _sorted_by_parent(query, sort: str, foreign_key, parent, parent_column, tie_breaker,
+                      narrowed: bool = False) -> list:
+    """Order by a column of a parent table (artist name, album title), as a list of queries
+
+    With a LEFT JOIN SQLite has to drive the loop from the child table, so
+    it walks all of it and sorts. Instead, rows without a parent (NULL
+    sorts first) get a query of their own, and the rest become an inner
+    join that SQLite drives from the index on the parent column: "+ 0"
+    rules out looking parents up by id, which SQLite would otherwise pick
+    on a database without statistics. When an equality filter already
+    `narrowed` the rows down, looking parents up by id is the better plan.
+    """
+    orphans = query.filter(foreign_key.is_(None))
+    parent_id = parent.id if narrowed else parent.id + 0
+    joined = query.join(parent, foreign_key == parent_id)
+    if sort.startswith("-"):
+        return [joined.order_by(parent_column.desc(), tie_breaker.desc()),
+                orphans.order_by(tie_breaker.desc())]
+    return [orphans.order_by(tie_breaker), joined.order_by(parent_column, tie_breaker)]
+
+def paginate(queries: list, skip: int, limit: int) -> list:
+    """OFFSET/LIMIT over the concatenated results of `queries`
+
+    A query is only counted when the page starts after its last row.
+    """
+    rows = []
+    for query in queries:
+        wanted = limit - len(rows) if limit >= 0 else limit
+        if wanted == 0:
+            break
+        page = query.offset(skip).limit(wanted).all()
+        rows.extend(page)
+        skip = 0 if page else max(skip - query.order_by(None).count(), 0)
+    return rows
+
+def explain_query_plan(db: Session, query) -> list:
+    """SQLite EXPLAIN QUERY PLAN lines for an ORM query"""
+    statement = query.statement.compile(
+        dialect=db.get_bind().dialect, compile_kwargs={"literal_binds": True}
+    )
+    return [row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {statement}"))]
+
+def uses_full_table_scan(db: Session, query) -> bool:
+    """Whether the plan reads a whole table to answer one page
+
+    That is a "SCAN <table>" without an index, or an index walk whose rows
+    all have to be sorted ("USE TEMP B-TREE FOR ORDER BY"). Sorting only
+    the rows that share one key of the walked index ("FOR RIGHT PART OF
+    ORDER BY") still stops at the LIMIT. The one expected full scan is the
+    unfiltered listing in id order, which walks the rowid.
+    """
+    plan = explain_query_plan(db, query)
+    sorts_everything = "USE TEMP B-TREE FOR ORDER BY" in plan
+    return any(
+        line.startswith("SCAN ") and ("USING" not in line or sorts_everything)
+        for line in plan
+    )
+
 # Artist operations
 def get_artist(db: Session, artist_id: int):
     return db.query(models.Artist).filter(models.Artist.id == artist_id).first()
@@ -8,8 +93,20 @@ def get_artist(db: Session, artist_id: int):
 def get_artist_by_name(db: Session, name: str):
     return db.query(models.Artist).filter(models.Artist.name == name).first()
 
-def get_artists(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Artist).offset(skip).limit(limit).all()
+ARTIST_SORT_FIELDS = {
+    "id": models.Artist.id,
+    "name": models.Artist.name,
+}
+
+def query_artists(db: Session, sort: str = "id", name_prefix: Optional[str] = None) -> list:
+    """Filtered and sorted artist queries (a single one), results concatenated"""
+    query = db.query(models.Artist)
+    if name_prefix:
+        query = query.filter(_prefix_filter(models.Artist.name, name_prefix))
+    return [_apply_sort(query, sort, ARTIST_SORT_FIELDS, models.Artist.id)]
+
+def get_artists(db: Session, skip: int = 0, limit: int = 100, **filters):
+    return paginate(query_artists(db, **filters), skip, limit)
 
 def create_artist(db: Session, artist: schemas.ArtistCreate):
     db_artist = models.Artist(name=artist.name)
@@ -22,8 +119,45 @@ def create_artist(db: Session, artist: schemas.ArtistCreate):
 def get_album(db: Session, album_id: int):
     return db.query(models.Album).filter(models.Album.id == album_id).first()
 
-def get_albums(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Album).offset(skip).limit(limit).all()
+def get_album_tracks(db: Session, album: models.Album):
+    """Tracks of the album, including album rows with the same title and artist
+
+    The scanner creates an album row per track, so an album's tracks are
+    spread over rows sharing title and artist. Ordered by file path, which
+    follows the track numbers in typical file names.
+    """
+    same_album = db.query(models.Album.id).filter(
+        models.Album.title == album.title,
+        models.Album.artist_id.is_(None) if album.artist_id is None else models.Album.artist_id == album.artist_id,
+    )
+    return db.query(models.Track).options(
+        joinedload(models.Track.artist), joinedload(models.Track.album)
+    ).filter(models.Track.album_id.in_(same_album)).order_by(models.Track.file_path).all()
+
+ALBUM_SORT_FIELDS = {
+    "id": models.Album.id,
+    "title": models.Album.title,
+    "artist": models.Artist.name,
+}
+
+def query_albums(db: Session, sort: str = "id", artist_id: Optional[int] = None,
+                 artist: Optional[str] = None, title_prefix: Optional[str] = None) -> list:
+    """Filtered and sorted album queries, results concatenated; raises ValueError for an unknown sort field"""
+    query = db.query(models.Album)
+    if artist_id is not None:
+        query = query.filter(models.Album.artist_id == artist_id)
+    if artist is not None:
+        query = query.filter(models.Album.artist_id == _artist_id_by_name(db, artist))
+    if title_prefix:
+        query = query.filter(_prefix_filter(models.Album.title, title_prefix))
+    if sort.lstrip("-") == "artist":
+        return _sorted_by_parent(query, sort, models.Album.artist_id, models.Artist,
+                                 models.Artist.name, models.Album.id,
+                                 narrowed=artist_id is not None or artist is not None)
+    return [_apply_sort(query, sort, ALBUM_SORT_FIELDS, models.Album.id)]
+
+def get_albums(db: Session, skip: int = 0, limit: int = 100, **filters):
+    return paginate(query_albums(db, **filters), skip, limit)
 
 def create_album(db: Session, album: schemas.AlbumCreate):
     db_album = models.Album(**album.dict())
@@ -42,8 +176,90 @@ def get_track_by_path(db: Session, file_path: str):
 def get_tracks(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Track).offset(skip).limit(limit).all()
 
-def get_tracks_with_details(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Track).offset(skip).limit(limit).all()
+TRACK_SORT_FIELDS = {
+    "id": models.Track.id,
+    "title": models.Track.title,
+    "duration": models.Track.duration,
+    "file_type": models.Track.file_type,
+    "play_count": models.Track.play_count,
+    "added_at": models.Track.added_at,
+    "artist": models.Artist.name,
+    "album": models.Album.title,
+}
+
+def query_tracks(db: Session, sort: str = "id", hide_duplicates: bool = False,
+                 artist_id: Optional[int] = None, album_id: Optional[int] = None,
+                 artist: Optional[str] = None, album: Optional[str] = None,
+                 file_type: Optional[str] = None, min_duration: Optional[float] = None,
+                 max_duration: Optional[float] = None, title_prefix: Optional[str] = None) -> list:
+    """Filtered and sorted track queries, results concatenated (see paginate)
+
+    Raises ValueError for an unknown sort field.
+    """
+    query = db.query(models.Track)
+    if hide_duplicates:
+        query = query.filter(models.Track.duplicate_of.is_(None))
+    if artist_id is not None:
+        query = query.filter(models.Track.artist_id == artist_id)
+    if album_id is not None:
+        query = query.filter(models.Track.album_id == album_id)
+    # Name filters become id lookups so the (artist_id, ...) / (album_id, ...) indexes apply
+    if artist is not None:
+        query = query.filter(models.Track.artist_id == _artist_id_by_name(db, artist))
+    if album is not None:
+        query = query.filter(models.Track.album_id.in_(
+            db.query(models.Album.id).filter(models.Album.title == album)
+        ))
+    if file_type is not None:
+        query = query.filter(models.Track.file_type == file_type.lower().lstrip("."))
+    if min_duration is not None:
+        query = query.filter(models.Track.duration >= min_duration)
+    if max_duration is not None:
+        query = query.filter(models.Track.duration <= max_duration)
+    if title_prefix:
+        query = query.filter(_prefix_filter(models.Track.title, title_prefix))
+    key = sort.lstrip("-")
+    narrowed = any(value is not None for value in (artist_id, album_id, artist, album))
+    if key == "artist":
+        return _sorted_by_parent(query, sort, models.Track.artist_id, models.Artist,
+                                 models.Artist.name, models.Track.id, narrowed)
+    if key == "album":
+        return _sorted_by_parent(query, sort, models.Track.album_id, models.Album,
+                                 models.Album.title, models.Track.id, narrowed)
+    sort_columns, tie_breaker = TRACK_SORT_FIELDS, models.Track.id
+    if key == "id" and (min_duration is not None or max_duration is not None):
+        # SQLite would rather walk the rowid and skip tracks outside the range,
+        # reading the whole table for a narrow one; "id + 0" can't use the rowid
+        # order, so it searches ix_tracks_duration and sorts the matches instead
+        tie_breaker = models.Track.id + 0
+        sort_columns = {**TRACK_SORT_FIELDS, "id": tie_breaker}
+    return [_apply_sort(query, sort, sort_columns, tie_breaker)]
+
+def get_tracks_with_details(db: Session, skip: int = 0, limit: int = 100, **filters):
+    # Load the TrackWithDetails relationships per page instead of per row
+    options = (
+        selectinload(models.Track.artist), selectinload(models.Track.album),
+        selectinload(models.Track.lyric), selectinload(models.Track.analysis),
+    )
+    return paginate([query.options(*options) for query in query_tracks(db, **filters)], skip, limit)
+
+def get_duplicate_groups(db: Session, skip: int = 0, limit: int = 100):
+    """Groups of byte-identical tracks, canonical (lowest id) track first"""
+    hashes = db.query(models.Track.content_hash).filter(
+        models.Track.duplicate_of.isnot(None)
+    ).distinct().order_by(models.Track.content_hash).offset(skip).limit(limit).all()
+    hashes = [h for (h,) in hashes]
+    if not hashes:
+        return []
+    tracks = db.query(models.Track).filter(
+        models.Track.content_hash.in_(hashes)
+    ).order_by(models.Track.content_hash, models.Track.id).all()
+    groups = {h: {"content_hash": h, "file_size": None, "tracks": []} for h in hashes}
+    for track in tracks:
+        group = groups[track.content_hash]
+        group["file_size"] = track.file_size
+        group["tracks"].append(track)
+    return list(groups.values())
 
 def create_track(db: Session, track: schemas.TrackCreate):
     db_track = models.Track(**track.dict())
@@ -52,6 +268,25 @@ def create_track(db: Session, track: schemas.TrackCreate):
     db.refresh(db_track)
     return db_track
 
+def increment_play_count(db: Session, track_id: int) -> Optional[int]:
+    """Add a play; returns the new count (None if the track is gone)"""
+    db.query(models.Track).filter(models.Track.id == track_id).update(
+        {models.Track.play_count: func.coalesce(models.Track.play_count, 0) + 1},
+        synchronize_session=False
+    )
+    db.commit()
+    return db.query(models.Track.play_count).filter(models.Track.id == track_id).scalar()
+
+def get_track_files(db: Session, track_ids: list):
+    """File path, bitrate, sample rate and size for a page of tracks, keyed by track id"""
+    if not track_ids:
+        return {}
+    rows = db.query(
+        models.Track.id, models.Track.file_path, models.Track.bitrate,
+        models.Track.sample_rate, models.Track.file_size
+    ).filter(models.Track.id.in_(track_ids)).all()
+    return {row.id: row for row in rows}
+
 def delete_track(db: Session, track_id: int):
     db_track = get_track(db, track_id)
     if db_track:
@@ -60,6 +295,17 @@ def delete_track(db: Session, track_id: int):
         return True
     return False
 
+# Track analysis operations
+def get_track_analysis(db: Session, track_id: int):
+    return db.query(models.TrackAnalysis).filter(models.TrackAnalysis.track_id == track_id).first()
+
+def get_track_analyses(db: Session, track_ids: list):
+    """Analysis rows for a page of tracks, keyed by track id"""
+    if not track_ids:
+        return {}
+    rows = db.query(models.TrackAnalysis).filter(models.TrackAnalysis.track_id.in_(track_ids)).all()
+    return {row.track_id: row for row in rows}
+
 # Playlist operations
 def get_playlist(db: Session, playlist_id: int):
     return db.query(models.Playlist).filter(models.Playlist.id == playlist_id).first()
@@ -67,8 +313,13 @@ def get_playlist(db: Session, playlist_id: int):
 def get_playlists(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Playlist).offset(skip).limit(limit).all()
 
-def get_playlist_with_tracks(db: Session, playlist_id: int):
-    playlist = db.query(models.Playlist).filter(models.Playlist.id == playlist_id).first()
+def get_playlist_with_tracks(db: Session, playlist_id: int, with_details: bool = False):
+    # Load entries and their tracks up front instead of one query per entry
+    track_load = selectinload(models.Playlist.tracks).joinedload(models.PlaylistTrack.track)
+    options = [track_load]
+    if with_details:
+        options += [track_load.joinedload(models.Track.artist), track_load.joinedload(models.Track.album)]
+    playlist = db.query(models.Playlist).options(*options).filter(models.Playlist.id == playlist_id).first()
     if playlist:
         # Load tracks with proper ordering
         playlist.tracks.sort(key=lambda pt: pt.order)
@@ -115,6 +366,26 @@ def create_default_playlists(db: Session):
         db.commit()
         db.refresh(all_music_playlist)
 
+def create_smart_playlist(db: Session, playlist: schemas.SmartPlaylistCreate):
+    db_playlist = models.Playlist(
+        name=playlist.name,
+        type="smart",
+        rules=json.dumps(playlist.rules, ensure_ascii=False)
+    )
+    db.add(db_playlist)
+    db.commit()
+    db.refresh(db_playlist)
+    return db_playlist
+
+def update_smart_playlist_rules(db: Session, playlist_id: int, rules: dict):
+    db_playlist = get_playlist(db, playlist_id)
+    if db_playlist and db_playlist.type == "smart":
+        db_playlist.rules = json.dumps(rules, ensure_ascii=False)
+        db.commit()
+        db.refresh(db_playlist)
+        return db_playlist
+    return None
+
 def update_playlist(db: Session, playlist_id: int, playlist: schemas.PlaylistCreate):
     db_playlist = get_playlist(db, playlist_id)
     if db_playlist:
@@ -155,6 +426,13 @@ def remove_track_from_playlist(db: Session, playlist_id: int, track_id: int):
 def get_lyric(db: Session, track_id: int):
     return db.query(models.Lyric).filter(models.Lyric.track_id == track_id).first()
 
+def get_lyrics(db: Session, track_ids: list):
+    """Lyrics for a page of tracks, keyed by track id"""
+    if not track_ids:
+        return {}
+    rows = db.query(models.Lyric).filter(models.Lyric.track_id.in_(track_ids)).all()
+    return {row.track_id: row for row in rows}
+
 def create_lyric(db: Session, lyric: schemas.LyricCreate):
     # Check if lyric already exists
     existing_lyric = get_lyric(db, lyric.track_id)
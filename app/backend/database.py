@@ -0,0 +1,65 @@
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import sessionmaker
+from .config import settings
+
+# Create database engine and session
+engine = create_engine(
+    settings.database_url,
+    connect_args={"check_same_thread": False, "timeout": settings.sqlite_busy_timeout},
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers in other workers proceed while the scan leader writes
+    cursor = dbapi_connection.cursor()
+    try:
+        # Only takes effect on a new database; lets maintenance vacuum in small steps
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    finally:
+        cursor.close()
+
+def upgrade_schema(metadata):
+    """Add columns and indexes that create_all() won't add to existing tables
+
+    create_all() only creates missing tables, so databases created by an
+    older version would lack newly added columns. New columns must be
+    nullable (SQLite can't add NOT NULL columns without a default).
+
+    A column can set `info={"backfill": <SQL expression>}`; rows where it is
+    NULL (added before the column existed) are then set to that expression.
+    This runs on every start, so databases upgraded before a backfill was
+    declared are repaired too. Returns the number of rows backfilled.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                print(f"Added column {table.name}.{column.name}")
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    backfilled = 0
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            for column in table.columns:
+                expression = column.info.get("backfill")
+                if expression is None:
+                    continue
+                result = conn.execute(text(
+                    f'UPDATE "{table.name}" SET "{column.name}" = {expression} WHERE "{column.name}" IS NULL'
+                ))
+                if result.rowcount:
+                    print(f"Backfilled {table.name}.{column.name} for {result.rowcount} rows")
+                    backfilled += result.rowcount
+    return backfilled
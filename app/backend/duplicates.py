@@ -0,0 +1,130 @@
+import os
+import hashlib
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from . import models
+
+# Bytes read from the start, middle and end of a file for the partial hash
+SAMPLE_SIZE = 64 * 1024
+# Read size for full hashes
+READ_SIZE = 1024 * 1024
+
+def partial_hash(file_path: str, size: int) -> str:
+    """Cheap fingerprint: file size plus three sampled chunks
+
+    Identical files always get the same value; different files almost
+    always differ, and a collision is settled with the full hash.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(file_path, "rb") as f:
+        if size <= 3 * SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            for offset in (0, size // 2 - SAMPLE_SIZE // 2, size - SAMPLE_SIZE):
+                f.seek(offset)
+                h.update(f.read(SAMPLE_SIZE))
+    return h.hexdigest()
+
+def full_hash(file_path: str) -> str:
+    h = hashlib.blake2b(digest_size=32)
+    with open(file_path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_fingerprint(file_path: str) -> dict:
+    """Size, mtime and partial hash of a file, as stored on models.Track"""
+    stat = os.stat(file_path)
+    return {
+        "file_size": stat.st_size,
+        "file_mtime": stat.st_mtime,
+        "partial_hash": partial_hash(file_path, stat.st_size),
+        "content_hash": None,
+        "crc32": None,
+    }
+
+def is_unchanged(track: models.Track, stat: os.stat_result) -> bool:
+    return (track.partial_hash is not None
+            and track.file_size == stat.st_size
+            and track.file_mtime == stat.st_mtime)
+
+def update_track_hash(db: Session, track: models.Track) -> bool:
+    """Re-hash a known track only if its size or mtime changed; returns True if it did"""
+    try:
+        stat = os.stat(track.file_path)
+        if is_unchanged(track, stat):
+            return False
+        fingerprint = file_fingerprint(track.file_path)
+    except OSError as e:
+        print(f"Error hashing file {track.file_path}: {e}")
+        return False
+    for key, value in fingerprint.items():
+        setattr(track, key, value)
+    db.commit()
+    return True
+
+def ensure_content_hash(db: Session, track: models.Track) -> Optional[str]:
+    if track.content_hash is None:
+        try:
+            track.content_hash = full_hash(track.file_path)
+        except OSError as e:
+            print(f"Error hashing file {track.file_path}: {e}")
+            return None
+        db.commit()
+    return track.content_hash
+
+def find_identical_track(db: Session, file_path: str, fingerprint: dict) -> Optional[models.Track]:
+    """Return an already indexed track with exactly the same content, if any
+
+    Lets the scanner copy metadata instead of parsing the same bytes again.
+    Sets fingerprint["content_hash"] when a full hash had to be computed.
+    """
+    candidates = db.query(models.Track).filter(
+        models.Track.partial_hash == fingerprint["partial_hash"],
+        models.Track.file_size == fingerprint["file_size"],
+        models.Track.file_path != file_path,
+    ).all()
+    if not candidates:
+        return None
+    fingerprint["content_hash"] = full_hash(file_path)
+    for candidate in candidates:
+        if ensure_content_hash(db, candidate) == fingerprint["content_hash"]:
+            return candidate
+    return None
+
+def refresh_duplicates(db: Session) -> int:
+    """Settle partial-hash collisions with full hashes and recompute duplicate_of
+
+    Only tracks sharing a partial hash with another track are fully hashed,
+    and only once (a changed file gets its content_hash cleared). Within a
+    group of identical files the lowest id is the canonical track.
+    Returns the number of tracks marked as duplicates.
+    """
+    colliding = db.query(models.Track.partial_hash).filter(
+        models.Track.partial_hash.isnot(None)
+    ).group_by(models.Track.partial_hash).having(func.count(models.Track.id) > 1).subquery()
+    unhashed = db.query(models.Track).filter(
+        models.Track.partial_hash.in_(db.query(colliding.c.partial_hash)),
+        models.Track.content_hash.is_(None),
+    ).all()
+    for track in unhashed:
+        ensure_content_hash(db, track)
+
+    canonical = db.query(
+        models.Track.content_hash, func.min(models.Track.id).label("canonical_id")
+    ).filter(
+        models.Track.content_hash.isnot(None)
+    ).group_by(models.Track.content_hash).having(func.count(models.Track.id) > 1).subquery()
+
+    # Set-based: clear stale marks, then point every non-canonical copy at its group's canonical id
+    db.query(models.Track).filter(models.Track.duplicate_of.isnot(None)).update(
+        {models.Track.duplicate_of: None}, synchronize_session=False
+    )
+    marked = db.query(models.Track).filter(
+        models.Track.content_hash == canonical.c.content_hash,
+        models.Track.id != canonical.c.canonical_id,
+    ).update({models.Track.duplicate_of: canonical.c.canonical_id}, synchronize_session=False)
+    db.commit()
+    return marked
@@ -0,0 +1,394 @@
+"""Load generator that simulates concurrent listeners against a running instance
+
+Each simulated user behaves like the web player: it opens the page, lists
+tracks and playlists, then keeps picking tracks, fetching their cover and
+lyrics and streaming them at playback speed, sometimes seeking. Streams
+are consumed through a simulated playback buffer, so a stall is counted
+whenever audio would have run out before the next bytes arrived.
+
+    python -m app.backend.load_test --url http://127.0.0.1:18000 --users 50 --ramp 30 --duration 120
+
+Only the standard library is used, so it runs from any checkout.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+# Audio buffered before playback starts, and the most a player reads ahead
+PREBUFFER_SECONDS = 2.0
+READ_AHEAD_SECONDS = 30.0
+# Assumed bitrate when a track has none (bits per second)
+DEFAULT_BITRATE = 320000
+READ_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 30.0
+PROGRESS_INTERVAL = 10.0
+
+
+class HttpResponse:
+    """Response of a minimal HTTP/1.1 client; one connection per request"""
+
+    def __init__(self, status: int, headers: Dict[str, str], reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    async def iter_chunks(self):
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    return
+                data = await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+                yield data
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                data = await self.reader.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise ConnectionError("Connection closed before the end of the body")
+                remaining -= len(data)
+                yield data
+        else:
+            while data := await self.reader.read(READ_SIZE):
+                yield data
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    def close(self):
+        self.writer.close()
+
+
+async def http_get(host: str, port: int, path: str, headers: Optional[Dict[str, str]] = None) -> HttpResponse:
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = [f"GET {path} HTTP/1.1", f"Host: {host}:{port}", "Connection: close", "User-Agent: tingting-load-test"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        writer.close()
+        raise ConnectionError("Empty response")
+    status = int(status_line.split()[1])
+    response_headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        response_headers[name.strip().lower()] = value.strip()
+    return HttpResponse(status, response_headers, reader, writer)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.bytes_received = 0
+        self.streams = 0
+        self.stalls = 0
+        self.stalled_streams = 0
+        self.stall_seconds = 0.0
+        self.startup_delays: List[float] = []
+        self.seeks_honored = 0
+        self.seeks_ignored = 0
+        self.active_users = 0
+        self.started_at = time.monotonic()
+
+    def record(self, endpoint: str, seconds: float, status: Optional[int]):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+        if status is None or status >= 500:
+            self.errors[endpoint] += 1
+
+    @property
+    def requests(self) -> int:
+        return sum(len(values) for values in self.latencies.values())
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors[endpoint],
+                "statuses": {str(status): count for status, count in self.statuses[endpoint].items()},
+                "rps": round(len(values) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        startups = sorted(self.startup_delays)
+        return {
+            "elapsed_seconds": round(elapsed, 1),
+            "requests": self.requests,
+            "errors": sum(self.errors.values()),
+            "requests_per_second": round(self.requests / elapsed, 2),
+            "megabytes_per_second": round(self.bytes_received / elapsed / 1e6, 2),
+            "streams": {
+                "count": self.streams,
+                "stalls": self.stalls,
+                "stalled_streams": self.stalled_streams,
+                "stall_seconds": round(self.stall_seconds, 2),
+                "startup_p50_ms": round(percentile(startups, 50) * 1000, 1),
+                "startup_p99_ms": round(percentile(startups, 99) * 1000, 1),
+                "seeks_honored": self.seeks_honored,
+                "seeks_ignored": self.seeks_ignored,
+            },
+            "endpoints": endpoints,
+        }
+
+
+class Listener:
+    """One simulated user session"""
+
+    def __init__(self, test: "LoadTest", user_id: int):
+        self.test = test
+        self.user_id = user_id
+        self.random = random.Random(test.seed + user_id)
+        self.tracks: List[dict] = []
+
+    async def get(self, endpoint: str, path: str) -> Optional[bytes]:
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self.test.get(path), REQUEST_TIMEOUT)
+            try:
+                body = await asyncio.wait_for(response.read(), REQUEST_TIMEOUT)
+            finally:
+                response.close()
+        except (OSError, asyncio.TimeoutError, ValueError, asyncio.IncompleteReadError):
+            self.test.stats.record(endpoint, time.monotonic() - started, None)
+            return None
+        self.test.stats.record(endpoint, time.monotonic() - started, response.status)
+        self.test.stats.bytes_received += len(body)
+        return body if response.status == 200 else None
+
+    async def get_json(self, endpoint: str, path: str):
+        body = await self.get(endpoint, path)
+        try:
+            return json.loads(body) if body is not None else None
+        except ValueError:
+            return None
+
+    async def think(self):
+        await asyncio.sleep(self.random.uniform(0.5, 1.5) * self.test.think_time)
+
+    async def run(self):
+        # Page load, like the browser does
+        await self.get("GET /", "/")
+        await self.get("GET /static/*", "/static/app.js")
+        await self.get("GET /static/*", "/static/styles.css")
+        self.tracks = await self.get_json("GET /api/tracks", "/api/tracks") or []
+        playlists = await self.get_json("GET /api/playlists", "/api/playlists") or []
+        while not self.test.stopping:
+            await self.think()
+            if playlists and self.random.random() < 0.2:
+                playlist = self.random.choice(playlists)
+                await self.get("GET /api/playlists/{id}", f"/api/playlists/{playlist['id']}")
+                continue
+            if not self.tracks:
+                self.tracks = await self.get_json("GET /api/tracks", "/api/tracks") or []
+                continue
+            track = self.random.choice(self.tracks)
+            await self.get("GET /api/tracks/{id}/cover", f"/api/tracks/{track['id']}/cover")
+            await self.get("GET /api/tracks/{id}/lyric", f"/api/tracks/{track['id']}/lyric")
+            await self.listen(track)
+
+    async def listen(self, track: dict):
+        """Play part of a track at playback speed, maybe seeking halfway through"""
+        rate = (track.get("bitrate") or DEFAULT_BITRATE) / 8
+        listen_seconds = self.random.uniform(0.5, 1.5) * self.test.listen_time
+        if track.get("duration"):
+            listen_seconds = min(listen_seconds, track["duration"])
+        seek = track.get("file_size") and self.random.random() < self.test.seek_probability
+        if seek:
+            first = self.random.uniform(0.2, 0.8) * listen_seconds
+            await self.play(track, rate, first, "GET /api/tracks/{id}/stream")
+            offset = int(track["file_size"] * self.random.uniform(0.1, 0.9))
+            await self.play(track, rate, listen_seconds - first, "GET /api/tracks/{id}/stream (seek)", offset)
+        else:
+            await self.play(track, rate, listen_seconds, "GET /api/tracks/{id}/stream")
+
+    async def play(self, track: dict, rate: float, seconds: float, endpoint: str, offset: int = 0):
+        stats = self.test.stats
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self.test.get(f"/api/tracks/{track['id']}/stream", headers), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            stats.record(endpoint, time.monotonic() - started, None)
+            return
+        # Latency of a stream is its time to first byte (headers)
+        stats.record(endpoint, time.monotonic() - started, response.status)
+        if response.status not in (200, 206):
+            response.close()
+            return
+        if offset:
+            if response.status == 206:
+                stats.seeks_honored += 1
+            else:
+                stats.seeks_ignored += 1
+        stats.streams += 1
+
+        received = 0
+        playing_since = None  # playback clock start, shifted by stall time
+        stalls = 0
+        try:
+            chunks = response.iter_chunks()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), REQUEST_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                now = time.monotonic()
+                if playing_since is None:
+                    received += len(chunk)
+                    if received >= rate * PREBUFFER_SECONDS:
+                        playing_since = now
+                        stats.startup_delays.append(now - started)
+                else:
+                    # Playback ran dry before this chunk arrived: a stall until now
+                    ran_dry_at = playing_since + received / rate
+                    if ran_dry_at < now:
+                        stalls += 1
+                        stats.stall_seconds += now - ran_dry_at
+                        playing_since += now - ran_dry_at
+                    received += len(chunk)
+                stats.bytes_received += len(chunk)
+                if self.test.stopping:
+                    break
+                if playing_since is not None:
+                    played = (now - playing_since) * rate
+                    if played >= seconds * rate:
+                        break
+                    # Like a player, stop reading far ahead of the playback position
+                    ahead = (received - played) / rate - READ_AHEAD_SECONDS
+                    if ahead > 0:
+                        await asyncio.sleep(min(ahead, seconds - played / rate))
+                        if (time.monotonic() - playing_since) >= seconds:
+                            break
+        except (OSError, asyncio.TimeoutError, ValueError, asyncio.IncompleteReadError):
+            stats.errors[endpoint] += 1
+        finally:
+            response.close()
+        stats.stalls += stalls
+        stats.stalled_streams += bool(stalls)
+
+
+class LoadTest:
+    def __init__(self, url: str, users: int, ramp: float, duration: float,
+                 listen_time: float = 30.0, seek_probability: float = 0.3,
+                 think_time: float = 1.0, seed: int = 0):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("Only http:// URLs are supported")
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip("/")
+        self.users = users
+        self.ramp = ramp
+        self.duration = duration
+        self.listen_time = listen_time
+        self.seek_probability = seek_probability
+        self.think_time = think_time
+        self.seed = seed
+        self.stats = LoadStats()
+        self.stopping = False
+
+    async def get(self, path: str, headers: Optional[Dict[str, str]] = None) -> HttpResponse:
+        return await http_get(self.host, self.port, self.base_path + path, headers)
+
+    async def user(self, user_id: int):
+        await asyncio.sleep(self.ramp * user_id / max(self.users, 1))
+        if self.stopping:
+            return
+        self.stats.active_users += 1
+        try:
+            await Listener(self, user_id).run()
+        finally:
+            self.stats.active_users -= 1
+
+    async def progress(self):
+        while not self.stopping:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            stats = self.stats
+            print(f"[{time.monotonic() - stats.started_at:6.0f}s] users={stats.active_users} "
+                  f"requests={stats.requests} errors={sum(stats.errors.values())} "
+                  f"streams={stats.streams} stalls={stats.stalls}", flush=True)
+
+    async def run(self) -> dict:
+        self.stats = LoadStats()
+        tasks = [asyncio.create_task(self.user(i)) for i in range(self.users)]
+        reporter = asyncio.create_task(self.progress())
+        await asyncio.sleep(self.duration)
+        self.stopping = True
+        # Let in-flight requests finish briefly, then cut the rest off
+        done, pending = await asyncio.wait(tasks, timeout=5)
+        for task in list(pending) + [reporter]:
+            task.cancel()
+        await asyncio.gather(*tasks, reporter, return_exceptions=True)
+        return self.stats.report()
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"Duration {report['elapsed_seconds']}s, {report['requests']} requests "
+        f"({report['requests_per_second']}/s), {report['errors']} errors, "
+        f"{report['megabytes_per_second']} MB/s received",
+        "",
+        f"{'endpoint':<40}{'reqs':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    ]
+    for endpoint, row in report["endpoints"].items():
+        lines.append(f"{endpoint:<40}{row['requests']:>7}{row['errors']:>5}{row['p50_ms']:>9}"
+                     f"{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}")
+    streams = report["streams"]
+    lines += [
+        "",
+        f"Streams: {streams['count']}, stalls: {streams['stalls']} in {streams['stalled_streams']} streams "
+        f"({streams['stall_seconds']}s stalled), startup p50/p99: "
+        f"{streams['startup_p50_ms']}/{streams['startup_p99_ms']} ms",
+        f"Seeks: {streams['seeks_honored']} served with Range, {streams['seeks_ignored']} restarted from the beginning",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent listeners against a running instance")
+    parser.add_argument("--url", default="http://127.0.0.1:18000", help="Base URL of the instance")
+    parser.add_argument("--users", type=int, default=20, help="Number of simulated listeners")
+    parser.add_argument("--ramp", type=float, default=10.0, help="Seconds over which listeners join")
+    parser.add_argument("--duration", type=float, default=60.0, help="Total test duration in seconds")
+    parser.add_argument("--listen", type=float, default=30.0, help="Average seconds listened per track")
+    parser.add_argument("--seek-probability", type=float, default=0.3, help="Chance of seeking within a track")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Average pause between actions")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    test = LoadTest(args.url, args.users, args.ramp, args.duration, args.listen,
+                    args.seek_probability, args.think_time, args.seed)
+    report = asyncio.run(test.run())
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,167 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import Response, StreamingResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from starlette.background import BackgroundTask
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import quote
+import anyio
 import os
-from . import crud, models, schemas
+from . import crud, models, schemas, smart_playlists
 from .config import settings
+from .database import engine, SessionLocal, upgrade_schema
 from .music_scanner import scan_music_directory
+from .audio_analysis import AnalysisRunner, decode_peaks
+from .catalog import Catalog
+from .maintenance import MaintenanceRunner, read_last_report
+from .query_profiler import QueryProfiler
+from .stream_scheduler import StreamScheduler
+from .zip_download import ZipStream, build_archive, parse_range, safe_name, save_computed_crcs
+from .worker_sync import file_lock, try_file_lock, append_play, bump_library_generation, library_watcher
 
-# Create database engine and session
-engine = create_engine(
-    settings.database_url, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Create all tables
-models.Base.metadata.create_all(bind=engine)
+# Create all tables (serialized so concurrent workers don't race on CREATE TABLE)
+with file_lock("schema"):
+    models.Base.metadata.create_all(bind=engine)
+    if upgrade_schema(models.Base.metadata):
+        # Backfilled rows may now match (or stop matching) smart playlist rules
+        db = SessionLocal()
+        try:
+            smart_playlists.refresh_all(db)
+        finally:
+            db.close()
+        bump_library_generation()
 
 # Initialize FastAPI app
 app = FastAPI(title="听听音乐 API", description="一个简单的NAS音乐播放器API")
 
+# Shared scheduler for all /stream responses
+stream_scheduler = StreamScheduler(
+    max_streams=settings.stream_max_concurrent,
+    client_rate=settings.stream_client_rate,
+    client_burst=settings.stream_client_burst,
+    uplink_rate=settings.stream_uplink_rate,
+    workers=settings.web_concurrency,
+)
+
+# Play counts are written by a single background thread, so /stream never waits on SQLite
+play_recorder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="play-count")
+
+# Waveform/loudness analysis, run in the background after each scan
+analysis_runner = AnalysisRunner(
+    SessionLocal,
+    workers=settings.analysis_workers,
+    points=settings.waveform_points,
+    on_complete=bump_library_generation,
+)
+
+# Optional in-memory catalog for the listing endpoints, rebuilt on library changes
+catalog = Catalog(SessionLocal, enabled=settings.catalog_enabled)
+library_watcher.on_change(catalog.schedule_rebuild)
+
+# Periodic orphan cleanup, statistics and incremental vacuum
+maintenance_runner = MaintenanceRunner(
+    SessionLocal,
+    interval_hours=settings.maintenance_interval_hours,
+    batch_size=settings.maintenance_batch_size,
+    max_lock_ms=settings.maintenance_max_lock_ms,
+    on_change=bump_library_generation,
+)
+
+# Opt-in per-request query profiling (no engine listeners unless enabled)
+query_profiler = QueryProfiler(
+    engine,
+    enabled=settings.profile_queries,
+    n_plus_one_threshold=settings.profile_n_plus_one_threshold,
+    budget=settings.query_budget,
+    budgets=settings.query_budgets,
+)
+
 # Mount static files and templates
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
+def run_library_scan(music_dir: str, create_playlists: bool = False, lock=None) -> bool:
+    """Scan the library unless another worker is already doing it
+
+    Only the worker holding the scan lock touches the database; when it is
+    done every worker is told to drop its caches through the library
+    generation. `lock` is a scan lock the caller already claimed with
+    try_file_lock (released here). Returns False if the scan was skipped.
+    """
+    if lock is None:
+        lock = try_file_lock("scan")
+        if lock is None:
+            print("Another worker is scanning the music directory, skipping")
+            return False
+    with lock:
+        db = SessionLocal()
+        try:
+            if create_playlists:
+                create_startup_playlists(db)
+            scan_music_directory(db, music_dir)
+        finally:
+            db.close()
+    bump_library_generation()
+    analysis_runner.start()
+    return True
+
 # Startup event - scan music directory and create default playlists
 @app.on_event("startup")
 def startup_event():
-    db = SessionLocal()
+    library_watcher.check(force=True)
+    # With several workers only the scan leader creates playlists and scans
+    run_library_scan(settings.music_dir, create_playlists=True)
+    catalog.schedule_rebuild(library_watcher.check(force=True))
+    maintenance_runner.start()
+
+def create_startup_playlists(db: Session):
+    # Create default playlists
+    from . import crud
+    crud.create_default_playlists(db)
+    
+    # Create "全部音乐" playlist if it doesn't exist
+    all_music_playlist = db.query(models.Playlist).filter(
+        models.Playlist.name == "全部音乐"
+    ).first()
+    if not all_music_playlist:
+        all_music_playlist = models.Playlist(
+            name="全部音乐",
+            type="all",
+            music_dir=settings.music_dir
+        )
+        db.add(all_music_playlist)
+        db.commit()
+
+# Pick up library changes made by other workers before handling the request
+@app.middleware("http")
+async def check_library_generation(request: Request, call_next):
+    library_watcher.check()
+    return await call_next(request)
+
+# Count the queries each request runs; queries made while a streamed body is sent aren't included
+@app.middleware("http")
+async def profile_request_queries(request: Request, call_next):
+    if not query_profiler.enabled:
+        return await call_next(request)
+    profile, token = query_profiler.start(request.method, request.url.path)
     try:
-        # Create default playlists
-        from . import crud
-        crud.create_default_playlists(db)
-        
-        # Create "全部音乐" playlist if it doesn't exist
-        all_music_playlist = db.query(models.Playlist).filter(
-            models.Playlist.name == "全部音乐"
-        ).first()
-        if not all_music_playlist:
-            all_music_playlist = models.Playlist(
-                name="全部音乐",
-                type="all",
-                music_dir=settings.music_dir
-            )
-            db.add(all_music_playlist)
-            db.commit()
-        
-        # Scan music directory in background
-        scan_music_directory(db, settings.music_dir)
+        response = await call_next(request)
     finally:
-        db.close()
+        query_profiler.stop(token)
+    route = request.scope.get("route")
+    query_profiler.finish(profile, getattr(route, "path", request.url.path), response.status_code)
+    headers = query_profiler.headers(profile)
+    if query_profiler.over_budget(profile):
+        budget = query_profiler.budget_for(profile.route)
+        print(f"Query budget exceeded: {request.method} {profile.route} ran {profile.count} queries (budget {budget})")
+        return JSONResponse(status_code=500, headers=headers, content={
+            "detail": f"Query budget exceeded: {profile.count} queries (budget {budget})",
+            "profile": profile.summary(query_profiler.n_plus_one_threshold),
+        })
+    response.headers.update(headers)
+    return response
 
 # Dependency to get DB session
 def get_db():
@@ -60,6 +171,11 @@ def get_db():
     finally:
         db.close()
 
+# Helper to turn skip/limit into slice bounds with SQLite's OFFSET/LIMIT semantics
+def page_bounds(skip: int, limit: int):
+    start = max(skip, 0)
+    return start, (None if limit < 0 else start + limit)
+
 # Helper function to detect if request is from a mobile device
 def is_mobile_device(request: Request) -> bool:
     user_agent = request.headers.get("user-agent", "").lower()
@@ -92,17 +208,48 @@ def read_mobile_settings(request: Request):
 
 # API endpoints
 @app.post("/api/scan")
-def scan_music(background_tasks: BackgroundTasks, db: Session = Depends(get_db), music_dir: str = None):
+def scan_music(background_tasks: BackgroundTasks, music_dir: str = None):
     # 如果提供了新的音乐目录，使用新目录，否则使用配置中的目录
     scan_dir = music_dir if music_dir else settings.music_dir
-    background_tasks.add_task(scan_music_directory, db, scan_dir)
+    # Claim the lock now so the caller learns about a scan or maintenance run already in progress
+    lock = try_file_lock("scan")
+    if lock is None:
+        raise HTTPException(status_code=409, detail="A music scan or database maintenance is already running")
+    background_tasks.add_task(run_library_scan, scan_dir, lock=lock)
     return {"message": "Music scan started"}
 
 @app.get("/api/tracks", response_model=list[schemas.TrackWithDetails])
-def read_tracks(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    tracks = crud.get_tracks_with_details(db, skip=skip, limit=limit)
+def read_tracks(skip: int = 0, limit: int = 100, hide_duplicates: bool = False,
+                sort: str = "id", artist_id: int = None, album_id: int = None,
+                artist: str = None, album: str = None, file_type: str = None,
+                min_duration: float = None, max_duration: float = None,
+                title_prefix: str = None, db: Session = Depends(get_db)):
+    filters = dict(
+        hide_duplicates=hide_duplicates, sort=sort, artist_id=artist_id, album_id=album_id,
+        artist=artist, album=album, file_type=file_type, min_duration=min_duration,
+        max_duration=max_duration, title_prefix=title_prefix
+    )
+    snapshot = catalog.current(library_watcher.generation)
+    try:
+        if snapshot is not None:
+            positions = list(islice(snapshot.query_tracks(**filters), *page_bounds(skip, limit)))
+            track_ids = [snapshot.ids[p] for p in positions]
+            # File details, lyrics and analysis stay in the database; one query each per page
+            files = crud.get_track_files(db, track_ids)
+            lyrics = {k: schemas.Lyric.model_validate(v).model_dump(mode="json")
+                      for k, v in crud.get_lyrics(db, track_ids).items()}
+            analyses = {k: schemas.TrackAnalysis.model_validate(v).model_dump(mode="json")
+                        for k, v in crud.get_track_analyses(db, track_ids).items()}
+            return JSONResponse(snapshot.track_dicts(positions, files, lyrics, analyses))
+        tracks = crud.get_tracks_with_details(db, skip=skip, limit=limit, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return tracks
 
+@app.get("/api/duplicates", response_model=list[schemas.DuplicateGroup])
+def read_duplicates(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return crud.get_duplicate_groups(db, skip=skip, limit=limit)
+
 @app.get("/api/tracks/{track_id}", response_model=schemas.TrackWithDetails)
 def read_track(track_id: int, db: Session = Depends(get_db)):
     db_track = crud.get_track(db, track_id=track_id)
@@ -110,8 +257,33 @@ def read_track(track_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Track not found")
     return db_track
 
+@app.get("/api/tracks/{track_id}/waveform", response_model=schemas.Waveform)
+def read_waveform(track_id: int, points: int = None, db: Session = Depends(get_db)):
+    analysis = crud.get_track_analysis(db, track_id=track_id)
+    if analysis is None or not analysis.peaks:
+        raise HTTPException(status_code=404, detail="Waveform not available")
+    peaks = decode_peaks(analysis.peaks, points)
+    return {"track_id": track_id, "points": len(peaks), "peaks": peaks}
+
+def record_play(track_id: int):
+    """Count a play; smart playlists and every worker's catalog see it right away"""
+    db = SessionLocal()
+    try:
+        play_count = crud.increment_play_count(db, track_id)
+        if play_count is not None:
+            append_play(track_id, play_count)
+        smart_playlists.refresh_for_tracks(db, [track_id], fields={"play_count"})
+    except Exception as e:
+        print(f"Error recording play of track {track_id}: {e}")
+    finally:
+        db.close()
+
+def is_new_listen(range_header: str) -> bool:
+    """The player re-requests the file with a Range on every seek or resume; only a read from the start is a new listen"""
+    return not range_header or range_header.replace(" ", "").lower().startswith("bytes=0-")
+
 @app.get("/api/tracks/{track_id}/stream")
-def stream_track(track_id: int, db: Session = Depends(get_db)):
+def stream_track(track_id: int, request: Request, db: Session = Depends(get_db)):
     db_track = crud.get_track(db, track_id=track_id)
     if db_track is None:
         raise HTTPException(status_code=404, detail="Track not found")
@@ -119,10 +291,7 @@ def stream_track(track_id: int, db: Session = Depends(get_db)):
     if not os.path.exists(db_track.file_path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    def iterfile():
-        with open(db_track.file_path, "rb") as f:
-            while chunk := f.read(1024 * 1024):  # 1MB chunks
-                yield chunk
+    file_path = db_track.file_path
     
     # Get MIME type based on file extension
     mime_types = {
@@ -139,18 +308,156 @@ def stream_track(track_id: int, db: Session = Depends(get_db)):
     ext = os.path.splitext(db_track.file_path)[1].lower()
     mime_type = mime_types.get(ext, "audio/mpeg")
     
-    return StreamingResponse(iterfile(), media_type=mime_type)
+    # The body can take minutes; don't hold a pooled connection while it is sent
+    db.close()
+    
+    # Take the slot last: nothing between here and the response may raise and leak it
+    client = request.client.host if request.client else "unknown"
+    handle = stream_scheduler.open_stream(client, track_id)
+    if handle is None:
+        raise HTTPException(status_code=503, detail="Too many concurrent streams",
+                            headers={"Retry-After": "5"})
+    
+    # One play per admitted listen, not per seek or rejected retry; the write happens off the request path
+    if is_new_listen(request.headers.get("range")):
+        play_recorder.submit(record_play, track_id)
+    
+    # Async so waiting for the rate limit doesn't tie up a threadpool worker; reads still use threads
+    async def iterfile():
+        try:
+            async with await anyio.open_file(file_path, "rb") as f:
+                while chunk := await f.read(handle.chunk_size):
+                    await handle.throttle(len(chunk))
+                    yield chunk
+        finally:
+            handle.release()
+    
+    # release() is idempotent; the background task also covers a body that was never iterated
+    return StreamingResponse(iterfile(), media_type=mime_type,
+                             background=BackgroundTask(handle.release))
+
+def zip_download(request: Request, db: Session, archive: ZipStream, download_name: str):
+    """Stream an archive, honouring single Range requests (with If-Range) for resume"""
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag,
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(safe_name(download_name, 'music') + '.zip')}",
+    }
+    start, stop, status_code = 0, archive.size, 200
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", archive.etag) == archive.etag:
+        try:
+            byte_range = parse_range(range_header, archive.size)
+        except ValueError:
+            raise HTTPException(status_code=416, detail="Range not satisfiable",
+                                headers={"Content-Range": f"bytes */{archive.size}"})
+        if byte_range:
+            start, stop = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive.size}"
+    headers["Content-Length"] = str(stop - start)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type="application/zip")
+    
+    # Like /stream, release the pooled connection before the (long) body is sent
+    db.close()
+    
+    # Downloads share the stream slots and bandwidth with playback
+    client = request.client.host if request.client else "unknown"
+    handle = stream_scheduler.open_stream(client, None)
+    if handle is None:
+        raise HTTPException(status_code=503, detail="Too many concurrent streams",
+                            headers={"Retry-After": "5"})
+    
+    def save_crcs():
+        db = SessionLocal()
+        try:
+            save_computed_crcs(db, archive)
+        finally:
+            db.close()
+    
+    async def iterzip():
+        chunks = archive.iter_bytes(start, stop, handle.chunk_size)
+        try:
+            while (chunk := await anyio.to_thread.run_sync(next, chunks, None)) is not None:
+                await handle.throttle(len(chunk))
+                yield chunk
+        finally:
+            handle.release()
+            chunks.close()
+            if archive.computed_crcs:
+                # Still runs when the client disconnected and the body was cancelled
+                with anyio.CancelScope(shield=True):
+                    await anyio.to_thread.run_sync(save_crcs)
+    
+    return StreamingResponse(iterzip(), status_code=status_code, media_type="application/zip",
+                             headers=headers, background=BackgroundTask(handle.release))
+
+@app.get("/api/admin/streams")
+def read_stream_scheduler():
+    return stream_scheduler.snapshot()
+
+@app.get("/api/admin/catalog")
+def read_catalog_status():
+    return catalog.status()
+
+@app.get("/api/admin/maintenance")
+def read_maintenance_report():
+    return {"running": maintenance_runner.running, "last_run": read_last_report()}
+
+@app.post("/api/admin/maintenance")
+def run_maintenance(background_tasks: BackgroundTasks):
+    if maintenance_runner.running:
+        return {"message": "Database maintenance already running"}
+    background_tasks.add_task(maintenance_runner.run_once)
+    return {"message": "Database maintenance started"}
+
+@app.get("/api/admin/queries")
+def read_query_profile():
+    return query_profiler.snapshot()
+
+@app.delete("/api/admin/queries")
+def reset_query_profile():
+    query_profiler.reset()
+    return {"message": "Query profile reset"}
 
 @app.get("/api/artists", response_model=list[schemas.Artist])
-def read_artists(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    artists = crud.get_artists(db, skip=skip, limit=limit)
+def read_artists(skip: int = 0, limit: int = 100, sort: str = "id", name_prefix: str = None,
+                 db: Session = Depends(get_db)):
+    snapshot = catalog.current(library_watcher.generation)
+    try:
+        if snapshot is not None:
+            artists = snapshot.list_artists(sort=sort, name_prefix=name_prefix)
+            return JSONResponse(list(islice(artists, *page_bounds(skip, limit))))
+        artists = crud.get_artists(db, skip=skip, limit=limit, sort=sort, name_prefix=name_prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return artists
 
 @app.get("/api/albums", response_model=list[schemas.Album])
-def read_albums(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    albums = crud.get_albums(db, skip=skip, limit=limit)
+def read_albums(skip: int = 0, limit: int = 100, sort: str = "id", artist_id: int = None,
+                artist: str = None, title_prefix: str = None, db: Session = Depends(get_db)):
+    snapshot = catalog.current(library_watcher.generation)
+    try:
+        if snapshot is not None:
+            albums = snapshot.list_albums(sort=sort, artist_id=artist_id, artist=artist,
+                                          title_prefix=title_prefix)
+            return JSONResponse(list(islice(albums, *page_bounds(skip, limit))))
+        albums = crud.get_albums(db, skip=skip, limit=limit, sort=sort, artist_id=artist_id,
+                                 artist=artist, title_prefix=title_prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return albums
 
+@app.api_route("/api/albums/{album_id}/download", methods=["GET", "HEAD"])
+def download_album(album_id: int, request: Request, db: Session = Depends(get_db)):
+    album = crud.get_album(db, album_id=album_id)
+    if album is None:
+        raise HTTPException(status_code=404, detail="Album not found")
+    name = f"{album.artist.name} - {album.title}" if album.artist else album.title
+    archive = build_archive(name, crud.get_album_tracks(db, album), db, single_cover=True)
+    return zip_download(request, db, archive, name)
+
 # Playlist endpoints
 @app.get("/api/playlists", response_model=list[schemas.Playlist])
 def read_playlists(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
@@ -164,6 +471,15 @@ def read_playlist(playlist_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Playlist not found")
     return playlist
 
+@app.api_route("/api/playlists/{playlist_id}/download", methods=["GET", "HEAD"])
+def download_playlist(playlist_id: int, request: Request, db: Session = Depends(get_db)):
+    playlist = crud.get_playlist_with_tracks(db, playlist_id=playlist_id, with_details=True)
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    tracks = [pt.track for pt in playlist.tracks if pt.track is not None]
+    archive = build_archive(playlist.name, tracks, db, with_artist=True)
+    return zip_download(request, db, archive, playlist.name)
+
 @app.post("/api/playlists", response_model=schemas.Playlist)
 def create_playlist(playlist: schemas.PlaylistCreate, db: Session = Depends(get_db)):
     import os
@@ -182,6 +498,36 @@ def create_playlist(playlist: schemas.PlaylistCreate, db: Session = Depends(get_
     
     return crud.create_playlist(db=db, playlist=playlist)
 
+@app.post("/api/playlists/smart", response_model=schemas.Playlist)
+def create_smart_playlist(playlist: schemas.SmartPlaylistCreate, db: Session = Depends(get_db)):
+    try:
+        smart_playlists.compile_rules(playlist.rules)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db_playlist = crud.create_smart_playlist(db=db, playlist=playlist)
+    smart_playlists.refresh_playlist(db, db_playlist)
+    return db_playlist
+
+@app.put("/api/playlists/{playlist_id}/rules", response_model=schemas.Playlist)
+def update_smart_playlist_rules(playlist_id: int, rules: schemas.SmartPlaylistRules, db: Session = Depends(get_db)):
+    try:
+        smart_playlists.compile_rules(rules.rules)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db_playlist = crud.update_smart_playlist_rules(db=db, playlist_id=playlist_id, rules=rules.rules)
+    if db_playlist is None:
+        raise HTTPException(status_code=404, detail="Smart playlist not found")
+    smart_playlists.refresh_playlist(db, db_playlist)
+    return db_playlist
+
+@app.post("/api/playlists/{playlist_id}/refresh")
+def refresh_smart_playlist(playlist_id: int, db: Session = Depends(get_db)):
+    db_playlist = crud.get_playlist(db, playlist_id=playlist_id)
+    if db_playlist is None or db_playlist.type != "smart":
+        raise HTTPException(status_code=404, detail="Smart playlist not found")
+    count = smart_playlists.refresh_playlist(db, db_playlist)
+    return {"message": "Smart playlist refreshed", "tracks": count}
+
 @app.put("/api/playlists/{playlist_id}", response_model=schemas.Playlist)
 def update_playlist(playlist_id: int, playlist: schemas.PlaylistCreate, db: Session = Depends(get_db)):
     db_playlist = crud.update_playlist(db=db, playlist_id=playlist_id, playlist=playlist)
@@ -0,0 +1,320 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+from sqlalchemy import delete, exists, func, or_, select, text, update
+from sqlalchemy.orm import aliased
+from . import models
+from .worker_sync import file_lock, get_runtime_dir
+
+# Bounds for the adaptive batch size (rows or pages per transaction)
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+# The lock is left free for at least this long between batches
+MIN_PAUSE_SECONDS = 0.01
+# Rows ANALYZE samples per index on the first run (keeps it fast on big tables)
+ANALYSIS_LIMIT = 1000
+
+
+class BatchThrottle:
+    """Adapts the batch size so one write transaction stays around `target` seconds
+
+    After each batch it sleeps at least as long as the batch held the write
+    lock, so the API always gets the lock at least half of the time.
+    """
+
+    def __init__(self, batch_size: int, target: float):
+        self.batch_size = max(MIN_BATCH_SIZE, min(batch_size, MAX_BATCH_SIZE))
+        self.target = target
+        self.batches = 0
+        self.longest = 0.0
+
+    def pace(self, elapsed: float):
+        self.batches += 1
+        self.longest = max(self.longest, elapsed)
+        if elapsed > self.target:
+            self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+        elif elapsed < self.target / 4:
+            self.batch_size = min(MAX_BATCH_SIZE, self.batch_size * 2)
+        time.sleep(max(elapsed, MIN_PAUSE_SECONDS))
+
+
+def _run_batches(db, throttle: BatchThrottle, model, make_statement: Callable[[object], object]) -> int:
+    """Execute a statement over consecutive primary key windows of `model`, one commit each
+
+    `make_statement` gets the window condition. Walking the key keeps each
+    batch an index range scan instead of rescanning the table from the start.
+    """
+    last_id = db.execute(select(func.max(model.id))).scalar() or 0
+    total = 0
+    low = 0
+    while low < last_id:
+        high = low + throttle.batch_size
+        started = time.monotonic()
+        total += db.execute(make_statement((model.id > low) & (model.id <= high))).rowcount
+        db.commit()
+        throttle.pace(time.monotonic() - started)
+        low = high
+    return total
+
+
+def _orphans(model, condition):
+    """Statement factory deleting the rows of `model` in a window matching `condition`"""
+    def statement(window):
+        return delete(model).where(window, condition)
+    return statement
+
+
+def _track_missing(column):
+    return or_(column.is_(None), ~exists().where(models.Track.id == column))
+
+
+def merge_duplicate_albums(db, throttle: BatchThrottle) -> int:
+    """Point tracks at the lowest-id album with the same title and artist
+
+    The scanner creates an album row per track; afterwards the extra rows
+    have no tracks and are removed as orphans. Returns the tracks moved.
+    """
+    same = aliased(models.Album)
+    current = aliased(models.Album)
+    same_group = (same.title.is_not_distinct_from(current.title)
+                  & same.artist_id.is_not_distinct_from(current.artist_id))
+
+    # Keep a cover found on any of the merged rows
+    cover = select(func.max(same.cover_path)).where(
+        same.title.is_not_distinct_from(models.Album.title),
+        same.artist_id.is_not_distinct_from(models.Album.artist_id),
+    ).scalar_subquery()
+    has_older = exists().where(
+        same.title.is_not_distinct_from(models.Album.title),
+        same.artist_id.is_not_distinct_from(models.Album.artist_id),
+        same.id < models.Album.id,
+    )
+    has_cover = exists().where(
+        same.title.is_not_distinct_from(models.Album.title),
+        same.artist_id.is_not_distinct_from(models.Album.artist_id),
+        same.cover_path.isnot(None),
+    )
+
+    def covers(window):
+        return update(models.Album).where(
+            window, models.Album.cover_path.is_(None), ~has_older, has_cover
+        ).values(cover_path=cover)
+    _run_batches(db, throttle, models.Album, covers)
+
+    canonical = select(func.min(same.id)).where(
+        current.id == models.Track.album_id, same_group
+    ).scalar_subquery()
+    in_duplicate = exists().where(
+        current.id == models.Track.album_id, same_group, same.id < current.id
+    )
+
+    def statement(window):
+        return update(models.Track).where(window, in_duplicate).values(album_id=canonical)
+    return _run_batches(db, throttle, models.Track, statement)
+
+
+def collect_orphans(db, throttle: BatchThrottle) -> dict:
+    """Delete rows left pointing at nothing, children before parents"""
+    removed = {}
+    removed["playlist_tracks"] = _run_batches(db, throttle, models.PlaylistTrack, _orphans(
+        models.PlaylistTrack,
+        or_(_track_missing(models.PlaylistTrack.track_id),
+            ~exists().where(models.Playlist.id == models.PlaylistTrack.playlist_id)),
+    ))
+    removed["lyrics"] = _run_batches(db, throttle, models.Lyric, _orphans(
+        models.Lyric, _track_missing(models.Lyric.track_id)
+    ))
+    removed["track_analysis"] = _run_batches(db, throttle, models.TrackAnalysis, _orphans(
+        models.TrackAnalysis, _track_missing(models.TrackAnalysis.track_id)
+    ))
+    removed["albums"] = _run_batches(db, throttle, models.Album, _orphans(
+        models.Album, ~exists().where(models.Track.album_id == models.Album.id)
+    ))
+    removed["artists"] = _run_batches(db, throttle, models.Artist, _orphans(
+        models.Artist,
+        ~exists().where(models.Track.artist_id == models.Artist.id)
+        & ~exists().where(models.Album.artist_id == models.Artist.id),
+    ))
+    # duplicate_of pointing at a deleted track; the next scan recomputes it anyway
+    original = aliased(models.Track)
+
+    def dangling(window):
+        return update(models.Track).where(
+            window,
+            models.Track.duplicate_of.isnot(None),
+            ~exists().where(original.id == models.Track.duplicate_of),
+        ).values(duplicate_of=None)
+    removed["duplicate_links"] = _run_batches(db, throttle, models.Track, dangling)
+    return removed
+
+
+def _pragma(db, name: str):
+    return db.execute(text(f"PRAGMA {name}")).scalar()
+
+
+def update_statistics(db) -> str:
+    """Full ANALYZE (sampled) the first time, then PRAGMA optimize"""
+    has_stats = db.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    )).first()
+    if has_stats:
+        db.execute(text("PRAGMA optimize"))
+        result = "optimize"
+    else:
+        db.execute(text(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}"))
+        db.execute(text("ANALYZE"))
+        result = "analyze"
+    db.commit()
+    return result
+
+
+def incremental_vacuum(db, throttle: BatchThrottle) -> int:
+    """Release free pages in small steps; returns the pages released"""
+    released = 0
+    while True:
+        free_pages = _pragma(db, "freelist_count")
+        if not free_pages:
+            return released
+        pages = min(free_pages, throttle.batch_size)
+        started = time.monotonic()
+        # The pragma frees one page per step and has no result columns, so a
+        # plain execute would release a single page; executescript steps it to the end
+        db.connection().connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({pages})")
+        db.commit()
+        throttle.pace(time.monotonic() - started)
+        remaining = _pragma(db, "freelist_count")
+        released += free_pages - remaining
+        if remaining >= free_pages:
+            return released
+
+
+def _database_bytes(path: Optional[str]) -> int:
+    if not path:
+        return 0
+    return sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+
+
+def run_maintenance(db, batch_size: int, max_lock_ms: int) -> dict:
+    """Merge duplicate albums, collect orphans, refresh statistics, vacuum"""
+    started = time.time()
+    db_path = db.get_bind().url.database
+    page_size = _pragma(db, "page_size")
+    file_bytes_before = _database_bytes(db_path)
+    throttle = BatchThrottle(batch_size, max_lock_ms / 1000)
+
+    moved = merge_duplicate_albums(db, throttle)
+    removed = collect_orphans(db, throttle)
+    statistics = update_statistics(db)
+
+    # 0 = none, 1 = full, 2 = incremental; only incremental can be vacuumed in steps
+    auto_vacuum = _pragma(db, "auto_vacuum")
+    free_pages_before = _pragma(db, "freelist_count")
+    released = incremental_vacuum(db, throttle) if auto_vacuum == 2 else 0
+    # Copy the WAL back without waiting on readers, so the file can shrink
+    db.execute(text("PRAGMA wal_checkpoint(PASSIVE)")).fetchall()
+
+    file_bytes_after = _database_bytes(db_path)
+    return {
+        "started_at": started,
+        "seconds": round(time.time() - started, 2),
+        "tracks_moved_to_merged_albums": moved,
+        "removed": removed,
+        "statistics": statistics,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, str(auto_vacuum)),
+        "free_pages_before": free_pages_before,
+        "pages_released": released,
+        "reclaimed_bytes": released * page_size,
+        "file_bytes_before": file_bytes_before,
+        "file_bytes_after": file_bytes_after,
+        "batches": throttle.batches,
+        "longest_batch_ms": round(throttle.longest * 1000, 1),
+    }
+
+
+def _report_path() -> str:
+    return os.path.join(get_runtime_dir(), "maintenance.json")
+
+
+def read_last_report() -> Optional[dict]:
+    try:
+        with open(_report_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_report(report: dict):
+    path = _report_path()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f)
+    os.replace(tmp_path, path)
+
+
+class MaintenanceRunner:
+    """Runs database maintenance every `interval_hours` in a daemon thread
+
+    Holds the scan lock while running (a scan creating albums must not race
+    with orphan collection), so it is skipped while a scan is in progress,
+    and only one worker process runs it. `on_change` is called when
+    listings changed (albums merged or removed).
+    """
+
+    def __init__(self, session_factory, interval_hours: float, batch_size: int, max_lock_ms: int,
+                 on_change: Optional[Callable[[], None]] = None):
+        self.session_factory = session_factory
+        self.interval = interval_hours * 3600
+        self.batch_size = batch_size
+        self.max_lock_ms = max_lock_ms
+        self.on_change = on_change
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        """Start the schedule; the first run happens one interval after startup"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="db-maintenance", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.run_once()
+
+    def run_once(self) -> Optional[dict]:
+        """Run now in the calling thread; returns None if skipped"""
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+        try:
+            with file_lock("scan", blocking=False) as leader:
+                if not leader:
+                    print("Skipping database maintenance: a scan is running")
+                    return None
+                db = self.session_factory()
+                try:
+                    report = run_maintenance(db, self.batch_size, self.max_lock_ms)
+                except Exception as e:
+                    print(f"Database maintenance failed: {e}")
+                    return None
+                finally:
+                    db.close()
+                _write_report(report)
+                removed = report["removed"]
+                print(f"Database maintenance: removed {sum(removed.values())} orphan rows, "
+                      f"reclaimed {report['reclaimed_bytes']} bytes in {report['seconds']}s")
+                if (report["tracks_moved_to_merged_albums"] or removed["albums"] or removed["artists"]) \
+                        and self.on_change:
+                    self.on_change()
+                return report
+        finally:
+            self.running = False
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, Text, ForeignKey
+import time
+from sqlalchemy import Column, Integer, String, Float, Text, ForeignKey, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -23,6 +24,10 @@ class Album(Base):
     
     artist = relationship("Artist", back_populates="albums")
     tracks = relationship("Track", back_populates="album")
+    
+    __table_args__ = (
+        Index("ix_albums_artist_title", "artist_id", "title"),
+    )
 
 class Track(Base):
     __tablename__ = "tracks"
@@ -36,19 +41,46 @@ class Track(Base):
     duration = Column(Float)
     bitrate = Column(Integer)
     sample_rate = Column(Integer)
+    # Duplicate detection: size/mtime when hashed, cheap sampled hash, full hash on collision
+    file_size = Column(Integer, nullable=True)
+    file_mtime = Column(Float, nullable=True)
+    partial_hash = Column(String, nullable=True, index=True)
+    content_hash = Column(String, nullable=True, index=True)
+    crc32 = Column(Integer, nullable=True)  # cached by ZIP downloads, cleared when the file changes
+    duplicate_of = Column(Integer, ForeignKey("tracks.id"), nullable=True, index=True)
+    play_count = Column(Integer, default=0, nullable=True, info={"backfill": "0"})
+    # unix timestamp; tracks from before the column existed use their file mtime
+    added_at = Column(Float, default=time.time, nullable=True,
+                      info={"backfill": "COALESCE(file_mtime, CAST(strftime('%s', 'now') AS REAL))"})
     
     artist = relationship("Artist", back_populates="tracks")
     album = relationship("Album", back_populates="tracks")
     lyric = relationship("Lyric", back_populates="track", uselist=False)
+    analysis = relationship("TrackAnalysis", back_populates="track", uselist=False)
     playlist_tracks = relationship("PlaylistTrack", back_populates="track")
+    
+    __table_args__ = (
+        # Listing filters and sorts (see crud.query_tracks)
+        Index("ix_tracks_artist_title", "artist_id", "title"),
+        Index("ix_tracks_album_title", "album_id", "title"),
+        Index("ix_tracks_file_type_duration", "file_type", "duration"),
+        # Its rowid suffix gives the (file_type, id) order and file_type filters in id order
+        Index("ix_tracks_file_type", "file_type"),
+        Index("ix_tracks_duration", "duration"),
+        # Smart playlist rule fields
+        Index("ix_tracks_file_type_bitrate", "file_type", "bitrate"),
+        Index("ix_tracks_play_count", "play_count"),
+        Index("ix_tracks_added_at", "added_at"),
+    )
 
 class Playlist(Base):
     __tablename__ = "playlists"
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    type = Column(String, default="custom")  # custom, favorite, recent
+    type = Column(String, default="custom")  # custom, favorite, recent, all, smart
     music_dir = Column(String, nullable=True)  # 音乐文件夹路径
+    rules = Column(Text, nullable=True)  # JSON rules of a smart playlist
     
     tracks = relationship("PlaylistTrack", back_populates="playlist")
 
@@ -62,6 +94,12 @@ class PlaylistTrack(Base):
     
     playlist = relationship("Playlist", back_populates="tracks")
     track = relationship("Track", back_populates="playlist_tracks")
+    
+    __table_args__ = (
+        Index("ix_playlist_tracks_playlist_order", "playlist_id", "order"),
+        Index("ix_playlist_tracks_playlist_track", "playlist_id", "track_id"),
+        Index("ix_playlist_tracks_track", "track_id"),
+    )
 
 class Lyric(Base):
     __tablename__ = "lyrics"
@@ -71,3 +109,24 @@ class Lyric(Base):
     content = Column(Text)
     
     track = relationship("Track", back_populates="lyric")
+
+class TrackAnalysis(Base):
+    __tablename__ = "track_analysis"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    track_id = Column(Integer, ForeignKey("tracks.id"), unique=True)
+    version = Column(Integer)
+    status = Column(String)  # pcm, tags, unavailable, error
+    # File size/mtime when analysed, to detect changed files
+    file_size = Column(Integer)
+    file_mtime = Column(Float)
+    attempts = Column(Integer, nullable=True)  # consecutive failed runs on this file version
+    loudness = Column(Float, nullable=True)  # integrated loudness, LUFS
+    track_gain = Column(Float, nullable=True)  # ReplayGain, dB
+    track_peak = Column(Float, nullable=True)
+    album_gain = Column(Float, nullable=True)
+    album_peak = Column(Float, nullable=True)
+    peaks = Column(LargeBinary, nullable=True)  # waveform peaks, one uint8 per point
+    analyzed_at = Column(Float)
+    
+    track = relationship("Track", back_populates="analysis")
@@ -1,7 +1,7 @@
 import os
 from mutagen import File
 from sqlalchemy.orm import Session
-from . import models, schemas, crud
+from . import models, schemas, crud, duplicates, smart_playlists
 
 # Supported audio file extensions
 SUPPORTED_EXTENSIONS = [
@@ -22,6 +22,9 @@ def scan_music_directory(db: Session, music_dir: str):
     # First process all audio files to create track entries
     found_files = []
     lyric_files = []
+    # Ids of added/changed and removed tracks, for incremental smart playlist refresh
+    changed_track_ids = []
+    removed_track_ids = []
     
     for root, dirs, files in os.walk(music_dir):
         for file in files:
@@ -29,7 +32,9 @@ def scan_music_directory(db: Session, music_dir: str):
             ext = os.path.splitext(file)[1].lower()
             
             if ext in SUPPORTED_EXTENSIONS:
-                process_audio_file(db, file_path, ext)
+                track_id = process_audio_file(db, file_path, ext)
+                if track_id is not None:
+                    changed_track_ids.append(track_id)
                 found_files.append(file_path)
                 # Remove from existing tracks dictionary if found
                 if file_path in existing_track_paths:
@@ -40,29 +45,71 @@ def scan_music_directory(db: Session, music_dir: str):
     # Delete tracks that no longer exist in the filesystem
     for track_path, track in existing_track_paths.items():
         print(f"Removing deleted track: {track.title}")
+        removed_track_ids.append(track.id)
         crud.delete_track(db, track.id)
     
     # Then process all lyric files and associate with tracks
     for lyric_file in lyric_files:
         process_lyric_file(db, lyric_file)
     
+    # Settle partial-hash collisions and mark duplicate copies
+    marked = duplicates.refresh_duplicates(db)
+    if marked:
+        print(f"Found {marked} duplicate tracks")
+    
+    # Only re-evaluate the tracks this scan touched
+    smart_playlists.refresh_for_tracks(db, changed_track_ids + removed_track_ids)
+    
     print("Scan completed")
+    return {"changed": changed_track_ids, "removed": removed_track_ids}
 
 def process_audio_file(db: Session, file_path: str, ext: str):
-    """Process a single audio file and add to database"""
-    # Check if track already exists
+    """Process a single audio file and add to database
+
+    Returns the track id if the track was added or changed, otherwise None.
+    """
+    # Check if track already exists; only re-hash it if the file changed
     existing_track = crud.get_track_by_path(db, file_path)
     if existing_track:
-        return
+        if not duplicates.update_track_hash(db, existing_track):
+            return None
+        # The file changed on disk, so its tags may have changed too
+        update_track_metadata(db, existing_track, ext)
+        return existing_track.id
     
     try:
         # Check if this is a lyric file (shouldn't happen, but just in case)
         if ext in LYRIC_EXTENSIONS:
             return
         
+        # The same bytes are already indexed elsewhere: copy instead of parsing again
+        fingerprint = duplicates.file_fingerprint(file_path)
+        identical = duplicates.find_identical_track(db, file_path, fingerprint)
+        if identical:
+            # Titles of untagged files come from the file name, so don't copy those
+            title = identical.title
+            identical_ext = os.path.splitext(identical.file_path)[1]
+            if title == os.path.basename(identical.file_path).replace(identical_ext, ''):
+                title = os.path.basename(file_path).replace(ext, '')
+            track = schemas.TrackCreate(
+                title=title,
+                artist_id=identical.artist_id,
+                album_id=identical.album_id,
+                file_path=file_path,
+                file_type=ext[1:],
+                duration=identical.duration,
+                bitrate=identical.bitrate,
+                sample_rate=identical.sample_rate,
+                **fingerprint
+            )
+            db_track = crud.create_track(db, track)
+            print(f"Added duplicate of track {identical.id}: {file_path}")
+            return db_track.id
+        
         # Use mutagen to read metadata
         audio = File(file_path)
-        if not audio:
+        # An untagged WAV/AIFF is falsy (empty tags), so compare with None
+        if audio is None:
             return
         
         # Check if this is actually an audio file by trying to get duration
@@ -76,25 +123,7 @@ def process_audio_file(db: Session, file_path: str, ext: str):
         # Extract metadata
         metadata = extract_metadata(audio, file_path, ext)
         
-        # Create or get artist
-        artist_id = None
-        if metadata['artist']:
-            artist = crud.get_artist_by_name(db, metadata['artist'])
-            if not artist:
-                artist = crud.create_artist(db, schemas.ArtistCreate(name=metadata['artist']))
-            artist_id = artist.id
-        
-        # Create or get album
-        album_id = None
-        if metadata['album']:
-            # For simplicity, we're not checking for existing albums with same name and artist
-            # This could be improved later
-            album = schemas.AlbumCreate(
-                title=metadata['album'],
-                artist_id=artist_id
-            )
-            album = crud.create_album(db, album)
-            album_id = album.id
+        artist_id, album_id = get_artist_and_album(db, metadata)
         
         # Create track
         track = schemas.TrackCreate(
@@ -105,14 +134,63 @@ def process_audio_file(db: Session, file_path: str, ext: str):
             file_type=ext[1:],  # Remove leading dot
             duration=metadata['duration'],
             bitrate=metadata['bitrate'],
-            sample_rate=metadata['sample_rate']
+            sample_rate=metadata['sample_rate'],
+            **fingerprint
         )
         
-        crud.create_track(db, track)
+        db_track = crud.create_track(db, track)
         print(f"Added track: {metadata['title']} by {metadata['artist']}")
+        return db_track.id
         
     except Exception as e:
         print(f"Error processing file {file_path}: {e}")
+    return None
+
+def get_artist_and_album(db: Session, metadata: dict):
+    """Create or get the artist and album for extracted metadata"""
+    # Create or get artist
+    artist_id = None
+    if metadata['artist']:
+        artist = crud.get_artist_by_name(db, metadata['artist'])
+        if not artist:
+            artist = crud.create_artist(db, schemas.ArtistCreate(name=metadata['artist']))
+        artist_id = artist.id
+    
+    # Create or get album
+    album_id = None
+    if metadata['album']:
+        # For simplicity, we're not checking for existing albums with same name and artist
+        # This could be improved later
+        album = schemas.AlbumCreate(
+            title=metadata['album'],
+            artist_id=artist_id
+        )
+        album = crud.create_album(db, album)
+        album_id = album.id
+    
+    return artist_id, album_id
+
+def update_track_metadata(db: Session, track: models.Track, ext: str):
+    """Re-read the tags of a changed file and update its track"""
+    try:
+        audio = File(track.file_path)
+        if audio is None or not hasattr(audio, 'info'):
+            return
+        metadata = extract_metadata(audio, track.file_path, ext)
+        
+        current_artist = track.artist.name if track.artist else ''
+        current_album = track.album.title if track.album else ''
+        if metadata['artist'] != current_artist or metadata['album'] != current_album:
+            track.artist_id, track.album_id = get_artist_and_album(db, metadata)
+        
+        track.title = metadata['title']
+        track.duration = metadata['duration']
+        track.bitrate = metadata['bitrate']
+        track.sample_rate = metadata['sample_rate']
+        db.commit()
+        print(f"Updated track: {metadata['title']} by {metadata['artist']}")
+    except Exception as e:
+        print(f"Error updating file {track.file_path}: {e}")
 
 def extract_metadata(audio, file_path: str, ext: str) -> dict:
     """Extract metadata from audio file"""
@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from sqlalchemy import event
+
+# Requests kept for the debug endpoint
+HISTORY_SIZE = 100
+# Shapes listed per request in the debug output
+TOP_SHAPES = 5
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_WHITESPACE = re.compile(r"\s+")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("query_profile", default=None)
+
+
+def statement_shape(statement: str) -> str:
+    """Normalize a statement so that executions differing only in values compare equal
+
+    Bound parameters are already "?"; this also folds inlined literals and
+    expanded IN lists of any length.
+    """
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _STRING_LITERAL.sub("?", shape)
+    shape = _NUMBER_LITERAL.sub("?", shape)
+    return _PLACEHOLDER_LIST.sub("(?...)", shape)
+
+
+def _query_origin() -> Optional[str]:
+    """Innermost app frame that led to a query (skips SQLAlchemy and this module)"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(BACKEND_DIR) and not filename.endswith("query_profiler.py"):
+            return f"{os.path.basename(filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+class RequestProfile:
+    """Queries run on behalf of one request"""
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.route = path
+        self.started_at = time.time()
+        self.count = 0
+        self.db_time = 0.0
+        self.shapes: Counter = Counter()
+        self.origins: Dict[str, Optional[str]] = {}
+        self.status_code = None
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, duration: float):
+        shape = statement_shape(statement)
+        with self._lock:
+            self.count += 1
+            self.db_time += duration
+            self.shapes[shape] += 1
+            if shape not in self.origins:
+                self.origins[shape] = _query_origin()
+
+    def n_plus_one(self, threshold: int) -> List[dict]:
+        """SELECT shapes repeated at least `threshold` times: likely per-row lazy loads"""
+        return [
+            {"count": count, "statement": shape, "origin": self.origins.get(shape)}
+            for shape, count in self.shapes.most_common()
+            if count >= threshold and shape.upper().startswith("SELECT")
+        ]
+
+    def summary(self, threshold: int) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "queries": self.count,
+            "db_time_ms": round(self.db_time * 1000, 3),
+            "distinct_statements": len(self.shapes),
+            "n_plus_one": self.n_plus_one(threshold),
+            "top_statements": [
+                {"count": count, "statement": shape}
+                for shape, count in self.shapes.most_common(TOP_SHAPES)
+            ],
+        }
+
+
+class QueryProfiler:
+    """Opt-in per-request query counting and N+1 detection
+
+    Engine events attribute every cursor execution to the request profile
+    in the current context (the context is copied into FastAPI's threadpool,
+    so sync endpoints and dependencies are covered). Queries from background
+    threads such as scans have no profile and are ignored.
+    """
+
+    def __init__(self, engine, enabled: bool = False, n_plus_one_threshold: int = 5,
+                 budget: int = 0, budgets: Optional[Dict[str, int]] = None):
+        self.engine = engine
+        self.enabled = enabled
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.budget = budget
+        self.budgets = budgets or {}
+        self.recent = deque(maxlen=HISTORY_SIZE)
+        self.routes: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if enabled:
+            event.listen(engine, "before_cursor_execute", self._before_execute)
+            event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None and _current_profile.get() is not None:
+            context._profiler_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        if profile is None:
+            return
+        started = getattr(context, "_profiler_started", None)
+        profile.record(statement, time.perf_counter() - started if started else 0.0)
+
+    def start(self, method: str, path: str):
+        profile = RequestProfile(method, path)
+        return profile, _current_profile.set(profile)
+
+    def stop(self, token):
+        _current_profile.reset(token)
+
+    def budget_for(self, route: str) -> int:
+        return self.budgets.get(route, self.budget)
+
+    def over_budget(self, profile: RequestProfile) -> bool:
+        budget = self.budget_for(profile.route)
+        return budget > 0 and profile.count > budget
+
+    def finish(self, profile: RequestProfile, route: str, status_code: int):
+        profile.route = route
+        profile.status_code = status_code
+        flagged = profile.n_plus_one(self.n_plus_one_threshold)
+        with self._lock:
+            self.recent.append(profile)
+            stats = self.routes.setdefault(route, {
+                "requests": 0, "queries": 0, "max_queries": 0, "db_time_ms": 0.0,
+                "n_plus_one_requests": 0, "over_budget_requests": 0,
+            })
+            stats["requests"] += 1
+            stats["queries"] += profile.count
+            stats["max_queries"] = max(stats["max_queries"], profile.count)
+            stats["db_time_ms"] += profile.db_time * 1000
+            stats["n_plus_one_requests"] += bool(flagged)
+            stats["over_budget_requests"] += self.over_budget(profile)
+
+    def headers(self, profile: RequestProfile) -> Dict[str, str]:
+        return {
+            "X-Query-Count": str(profile.count),
+            "X-Query-Time-Ms": f"{profile.db_time * 1000:.3f}",
+            "X-Query-N-Plus-One": str(len(profile.n_plus_one(self.n_plus_one_threshold))),
+        }
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            recent = list(self.recent)
+            routes = {route: dict(stats) for route, stats in self.routes.items()}
+        for route, stats in routes.items():
+            stats["avg_queries"] = round(stats["queries"] / stats["requests"], 2)
+            stats["db_time_ms"] = round(stats["db_time_ms"], 3)
+            stats["budget"] = self.budget_for(route)
+        return {
+            "enabled": self.enabled,
+            "n_plus_one_threshold": self.n_plus_one_threshold,
+            "budget": self.budget,
+            "budgets": self.budgets,
+            "routes": dict(sorted(routes.items(), key=lambda item: -item[1]["avg_queries"])),
+            "recent": [profile.summary(self.n_plus_one_threshold) for profile in reversed(recent)],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.recent.clear()
+            self.routes.clear()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional, List
+import json
+from pydantic import BaseModel, field_validator
+from typing import Any, Optional, List
 
 class TrackBase(BaseModel):
     title: str
@@ -10,12 +11,19 @@ class TrackBase(BaseModel):
     duration: float
     bitrate: Optional[int] = None
     sample_rate: Optional[int] = None
+    file_size: Optional[int] = None
+    duplicate_of: Optional[int] = None
 
 class TrackCreate(TrackBase):
-    pass
+    file_mtime: Optional[float] = None
+    partial_hash: Optional[str] = None
+    content_hash: Optional[str] = None
+    crc32: Optional[int] = None
 
 class Track(TrackBase):
     id: int
+    play_count: Optional[int] = None
+    added_at: Optional[float] = None
     
     class Config:
         from_attributes = True
@@ -50,6 +58,7 @@ class TrackWithDetails(Track):
     artist: Optional[Artist] = None
     album: Optional[Album] = None
     lyric: Optional["Lyric"] = None
+    analysis: Optional["TrackAnalysis"] = None
 
 class LyricBase(BaseModel):
     content: str
@@ -64,6 +73,27 @@ class Lyric(LyricBase):
     class Config:
         from_attributes = True
 
+class TrackAnalysis(BaseModel):
+    status: Optional[str] = None
+    loudness: Optional[float] = None
+    track_gain: Optional[float] = None
+    track_peak: Optional[float] = None
+    album_gain: Optional[float] = None
+    album_peak: Optional[float] = None
+    
+    class Config:
+        from_attributes = True
+
+class Waveform(BaseModel):
+    track_id: int
+    points: int
+    peaks: List[float]
+
+class DuplicateGroup(BaseModel):
+    content_hash: str
+    file_size: Optional[int] = None
+    tracks: List[Track] = []
+
 class PlaylistBase(BaseModel):
     name: str
     type: str = "custom"
@@ -74,12 +104,36 @@ class PlaylistCreate(PlaylistBase):
 
 class Playlist(PlaylistBase):
     id: int
+    rules: Optional[dict] = None
+    
+    @field_validator("rules", mode="before")
+    @classmethod
+    def parse_rules(cls, value: Any):
+        # Stored as JSON text on models.Playlist
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
     
     class Config:
         from_attributes = True
 
 class PlaylistWithTracks(Playlist):
     tracks: List[Track] = []
+    
+    @field_validator("tracks", mode="before")
+    @classmethod
+    def unwrap_playlist_tracks(cls, value: Any):
+        # models.Playlist.tracks holds PlaylistTrack rows; expose their tracks,
+        # skipping entries whose track was deleted
+        tracks = [getattr(item, "track", item) for item in value or []]
+        return [track for track in tracks if track is not None]
+
+class SmartPlaylistCreate(BaseModel):
+    name: str
+    rules: dict
+
+class SmartPlaylistRules(BaseModel):
+    rules: dict
 
 class PlaylistTrackBase(BaseModel):
     playlist_id: int
@@ -0,0 +1,181 @@
+import json
+from datetime import datetime
+from typing import Iterable, Optional, Set
+from sqlalchemy import and_, or_, not_, select, insert, delete, literal
+from sqlalchemy.orm import Session
+from . import models
+
+# Rule fields and the column each one compiles to
+FIELDS = {
+    "title": models.Track.title,
+    "artist": models.Artist.name,
+    "album": models.Album.title,
+    "file_type": models.Track.file_type,
+    "bitrate": models.Track.bitrate,
+    "sample_rate": models.Track.sample_rate,
+    "duration": models.Track.duration,
+    "play_count": models.Track.play_count,
+    "date_added": models.Track.added_at,
+}
+TEXT_FIELDS = {"title", "artist", "album", "file_type"}
+OPERATORS = {"eq", "ne", "gt", "gte", "lt", "lte", "between", "in", "not_in", "contains", "startswith"}
+# Track ids per statement when refreshing incrementally (SQLite variable limit)
+ID_BATCH_SIZE = 500
+
+def _coerce(field: str, value):
+    if field == "date_added" and isinstance(value, str):
+        # ISO dates ("2025-12-01" or a full timestamp) compare as unix timestamps
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            raise ValueError(f"Invalid date for date_added: {value!r}")
+    if field in TEXT_FIELDS:
+        if not isinstance(value, str):
+            raise ValueError(f"Rule on {field} needs a string value")
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Rule on {field} needs a numeric value")
+    return value
+
+def _compile_condition(rule: dict):
+    field = rule.get("field")
+    op = rule.get("op", "eq")
+    if field not in FIELDS:
+        raise ValueError(f"Unknown rule field: {field!r}")
+    if op not in OPERATORS:
+        raise ValueError(f"Unknown rule operator: {op!r}")
+    column = FIELDS[field]
+    value = rule.get("value")
+
+    if op in ("in", "not_in", "between"):
+        if not isinstance(value, list) or not value:
+            raise ValueError(f"Operator {op} needs a non-empty list value")
+        values = [_coerce(field, v) for v in value]
+        if op == "between":
+            if len(values) != 2:
+                raise ValueError("Operator between needs [low, high]")
+            condition = column.between(values[0], values[1])
+        elif op == "in":
+            condition = column.in_(values)
+        else:
+            condition = column.notin_(values)
+    else:
+        value = _coerce(field, value)
+        if op in ("contains", "startswith") and field not in TEXT_FIELDS:
+            raise ValueError(f"Operator {op} only applies to text fields")
+        condition = {
+            "eq": lambda: column == value,
+            "ne": lambda: column != value,
+            "gt": lambda: column > value,
+            "gte": lambda: column >= value,
+            "lt": lambda: column < value,
+            "lte": lambda: column <= value,
+            "contains": lambda: column.contains(value, autoescape=True),
+            "startswith": lambda: column.startswith(value, autoescape=True),
+        }[op]()
+
+    # Artist/album rules become indexed id lookups instead of joins
+    if field == "artist":
+        return models.Track.artist_id.in_(select(models.Artist.id).where(condition))
+    if field == "album":
+        return models.Track.album_id.in_(select(models.Album.id).where(condition))
+    return condition
+
+def compile_rules(rules: dict):
+    """Compile a rule tree into a SQL condition on models.Track
+
+    A rule tree is {"match": "all" | "any", "rules": [...]} where each item
+    is either a nested tree or {"field": ..., "op": ..., "value": ...}, e.g.
+    {"match": "all", "rules": [
+        {"field": "file_type", "op": "in", "value": ["flac", "wav", "ape"]},
+        {"field": "bitrate", "op": "gt", "value": 320000}]}
+    Raises ValueError for invalid rules.
+    """
+    if not isinstance(rules, dict):
+        raise ValueError("Rules must be an object")
+    if "field" in rules:
+        return _compile_condition(rules)
+    match = rules.get("match", "all")
+    if match not in ("all", "any", "none"):
+        raise ValueError(f"Unknown match mode: {match!r}")
+    items = rules.get("rules")
+    if not isinstance(items, list) or not items:
+        raise ValueError("Rules need a non-empty 'rules' list")
+    conditions = [compile_rules(item) for item in items]
+    if match == "all":
+        return and_(*conditions)
+    if match == "any":
+        return or_(*conditions)
+    return not_(or_(*conditions))
+
+def rule_fields(rules: dict) -> Set[str]:
+    if "field" in rules:
+        return {rules["field"]}
+    fields = set()
+    for item in rules.get("rules", []):
+        fields |= rule_fields(item)
+    return fields
+
+def load_rules(playlist: models.Playlist) -> dict:
+    return json.loads(playlist.rules) if playlist.rules else {}
+
+def get_smart_playlists(db: Session):
+    return db.query(models.Playlist).filter(models.Playlist.type == "smart").all()
+
+def _materialize(db: Session, playlist_id: int, condition):
+    """INSERT ... SELECT the matching tracks; track id doubles as the order"""
+    rows = select(literal(playlist_id), models.Track.id, models.Track.id).where(condition)
+    result = db.execute(insert(models.PlaylistTrack).from_select(
+        ["playlist_id", "track_id", "order"], rows
+    ))
+    return result.rowcount
+
+def refresh_playlist(db: Session, playlist: models.Playlist) -> int:
+    """Rematerialize a smart playlist from scratch; returns its track count"""
+    condition = compile_rules(load_rules(playlist))
+    db.execute(delete(models.PlaylistTrack).where(models.PlaylistTrack.playlist_id == playlist.id))
+    count = _materialize(db, playlist.id, condition)
+    db.commit()
+    return count
+
+def refresh_all(db: Session):
+    """Rematerialize every smart playlist, skipping ones with invalid rules"""
+    for playlist in get_smart_playlists(db):
+        try:
+            refresh_playlist(db, playlist)
+        except ValueError as e:
+            db.rollback()
+            print(f"Skipping smart playlist {playlist.name}: {e}")
+
+def refresh_for_tracks(db: Session, track_ids: Iterable[int], fields: Optional[Set[str]] = None):
+    """Re-evaluate only the given tracks against every smart playlist
+
+    Used after a scan (added, changed and removed tracks) and after a play
+    count change. With `fields`, playlists whose rules don't use any of
+    those fields are skipped.
+    """
+    track_ids = sorted(set(track_ids))
+    if not track_ids:
+        return
+    for playlist in get_smart_playlists(db):
+        try:
+            rules = load_rules(playlist)
+            if fields is not None and not (rule_fields(rules) & fields):
+                continue
+            condition = compile_rules(rules)
+        except ValueError as e:
+            print(f"Skipping smart playlist {playlist.name}: {e}")
+            continue
+        # Deleting a track nulls the track_id of its playlist entries
+        db.execute(delete(models.PlaylistTrack).where(
+            models.PlaylistTrack.playlist_id == playlist.id,
+            models.PlaylistTrack.track_id.is_(None),
+        ))
+        for i in range(0, len(track_ids), ID_BATCH_SIZE):
+            batch = track_ids[i:i + ID_BATCH_SIZE]
+            db.execute(delete(models.PlaylistTrack).where(
+                models.PlaylistTrack.playlist_id == playlist.id,
+                models.PlaylistTrack.track_id.in_(batch),
+            ))
+            _materialize(db, playlist.id, and_(models.Track.id.in_(batch), condition))
+    db.commit()
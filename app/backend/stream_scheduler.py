@@ -0,0 +1,215 @@
+import asyncio
+import threading
+import time
+from itertools import count
+from typing import Optional
+
+# Chunk size used when a stream is paced; small enough to keep the rate smooth
+PACED_CHUNK_SIZE = 64 * 1024
+# Chunk size used when no limit applies (same as the original iterfile)
+UNPACED_CHUNK_SIZE = 1024 * 1024
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` bytes/s and holding at most `burst` bytes"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, nbytes: int, now: float) -> float:
+        """Take `nbytes` from the bucket and return how long to wait before sending them"""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0.0
+        # Tokens may go negative: the debt is paid back by waiting
+        return -self.tokens / self.rate
+
+
+class StreamHandle:
+    """One active /stream response, paced by its client bucket and its uplink share"""
+
+    def __init__(self, scheduler: "StreamScheduler", stream_id: int, client: str, track_id: int):
+        self.scheduler = scheduler
+        self.id = stream_id
+        self.client = client
+        self.track_id = track_id
+        self.started_at = time.time()
+        self.bytes_sent = 0
+        # Rate assigned by the fair-share allocation, 0 means unlimited
+        self.rate = 0.0
+        self.bucket = TokenBucket(0.0, PACED_CHUNK_SIZE)
+        self.released = False
+
+    @property
+    def chunk_size(self) -> int:
+        if self.scheduler.is_throttling():
+            return PACED_CHUNK_SIZE
+        return UNPACED_CHUNK_SIZE
+
+    async def throttle(self, nbytes: int):
+        """Wait until `nbytes` may be sent without exceeding the configured rates
+
+        Waits on the event loop, so a paced stream doesn't hold a threadpool
+        worker that the (sync) API endpoints need.
+        """
+        delay = self.scheduler.reserve(self, nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class StreamScheduler:
+    """Admission control and bandwidth shaping for audio streams
+
+    - `max_streams` caps the number of concurrent streams (0 = unlimited)
+    - `client_rate`/`client_burst` limit each client address (0 = unlimited)
+    - `uplink_rate` is shared fairly (max-min) between active streams (0 = unlimited)
+
+    `max_streams` and `uplink_rate` are totals for the server; each of the
+    `workers` processes enforces an equal share of them. Client limits stay
+    as given (a client's streams usually land on one worker).
+    """
+
+    def __init__(self, max_streams: int = 0, client_rate: int = 0,
+                 client_burst: int = 0, uplink_rate: int = 0, workers: int = 1):
+        self.workers = max(workers, 1)
+        self.max_streams = self._share(max_streams)
+        self.client_rate = client_rate
+        self.client_burst = max(client_burst, PACED_CHUNK_SIZE)
+        self.uplink_rate = self._share(uplink_rate)
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        self._streams: dict[int, StreamHandle] = {}
+        self._client_buckets: dict[str, TokenBucket] = {}
+        self.rejected_total = 0
+        self.served_total = 0
+        self.bytes_total = 0
+
+    def _share(self, total: int) -> int:
+        """This process's share of a server-wide limit (0 stays unlimited, never below 1)"""
+        if total <= 0:
+            return 0
+        return max(total // self.workers, 1)
+
+    def is_throttling(self) -> bool:
+        return self.client_rate > 0 or self.uplink_rate > 0
+
+    def open_stream(self, client: str, track_id: int) -> Optional[StreamHandle]:
+        """Register a new stream, or return None when the concurrency cap is reached"""
+        with self._lock:
+            if self.max_streams and len(self._streams) >= self.max_streams:
+                self.rejected_total += 1
+                return None
+            handle = StreamHandle(self, next(self._ids), client, track_id)
+            self._streams[handle.id] = handle
+            if self.client_rate and client not in self._client_buckets:
+                self._client_buckets[client] = TokenBucket(self.client_rate, self.client_burst)
+            self.served_total += 1
+            self._rebalance()
+            return handle
+
+    def release(self, handle: StreamHandle):
+        with self._lock:
+            if handle.released:
+                return
+            handle.released = True
+            self._streams.pop(handle.id, None)
+            if not any(s.client == handle.client for s in self._streams.values()):
+                # Forget idle clients; a returning client starts with a full burst again
+                self._client_buckets.pop(handle.client, None)
+            self._rebalance()
+
+    def reserve(self, handle: StreamHandle, nbytes: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            handle.bytes_sent += nbytes
+            self.bytes_total += nbytes
+            delay = handle.bucket.reserve(nbytes, now)
+            client_bucket = self._client_buckets.get(handle.client)
+            if client_bucket is not None:
+                delay = max(delay, client_bucket.reserve(nbytes, now))
+            return delay
+
+    def _rebalance(self):
+        """Split the uplink between streams using max-min fair allocation
+
+        A stream never gets more than its client's rate divided between that
+        client's streams; bandwidth a limited stream cannot use is handed to
+        the others. Must be called with the lock held.
+        """
+        streams = list(self._streams.values())
+        if not streams:
+            return
+
+        per_client: dict[str, int] = {}
+        for s in streams:
+            per_client[s.client] = per_client.get(s.client, 0) + 1
+
+        def demand(s: StreamHandle) -> float:
+            if self.client_rate:
+                return self.client_rate / per_client[s.client]
+            return float("inf")
+
+        if not self.uplink_rate:
+            for s in streams:
+                s.rate = 0.0 if demand(s) == float("inf") else demand(s)
+                # The client bucket alone enforces the limit (with its burst)
+                s.bucket.rate = 0.0
+            return
+
+        remaining = float(self.uplink_rate)
+        pending = sorted(streams, key=demand)
+        while pending:
+            share = remaining / len(pending)
+            s = pending.pop(0)
+            s.rate = min(demand(s), share)
+            remaining -= s.rate
+            # Only pace the stream itself when the uplink is its bottleneck
+            s.bucket.rate = s.rate if share < demand(s) else 0.0
+            # Never allow more than ~0.25s of burst on top of the fair share
+            s.bucket.burst = max(PACED_CHUNK_SIZE, s.rate / 4)
+
+    def snapshot(self) -> dict:
+        """Current limits and active streams, for the admin endpoint"""
+        now = time.time()
+        with self._lock:
+            streams = []
+            clients: dict[str, dict] = {}
+            for s in self._streams.values():
+                elapsed = max(now - s.started_at, 1e-6)
+                streams.append({
+                    "id": s.id,
+                    "client": s.client,
+                    "track_id": s.track_id,
+                    "started_at": s.started_at,
+                    "bytes_sent": s.bytes_sent,
+                    "rate_limit": s.rate or None,
+                    "average_rate": s.bytes_sent / elapsed,
+                })
+                info = clients.setdefault(s.client, {"streams": 0, "bytes_sent": 0})
+                info["streams"] += 1
+                info["bytes_sent"] += s.bytes_sent
+            return {
+                "limits": {
+                    "max_streams": self.max_streams or None,
+                    "client_rate": self.client_rate or None,
+                    "client_burst": self.client_burst if self.client_rate else None,
+                    "uplink_rate": self.uplink_rate or None,
+                    "workers": self.workers,
+                },
+                "active_streams": len(streams),
+                "served_total": self.served_total,
+                "rejected_total": self.rejected_total,
+                "bytes_total": self.bytes_total,
+                "clients": clients,
+                "streams": streams,
+            }
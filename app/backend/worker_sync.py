@@ -0,0 +1,199 @@
+import os
+import struct
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, List, Optional, Tuple
+
+from .config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# How often (seconds) a worker looks at the generation file at most
+GENERATION_CHECK_INTERVAL = 1.0
+# Play log record: track id and its play count after the play
+PLAY_RECORD = struct.Struct("<iI")
+# The play log starts over past this size (about 130k plays)
+PLAY_LOG_MAX_BYTES = 1024 * 1024
+
+def get_runtime_dir() -> str:
+    """Directory shared by all workers for lock and generation files"""
+    if settings.runtime_dir:
+        runtime_dir = settings.runtime_dir
+    elif settings.database_url.startswith("sqlite:///"):
+        # Keep them next to the SQLite file so every worker sees the same ones
+        runtime_dir = os.path.dirname(settings.database_url[len("sqlite:///"):]) or "."
+    else:
+        runtime_dir = "."
+    os.makedirs(runtime_dir, exist_ok=True)
+    return runtime_dir
+
+def _lock_file(f, blocking: bool) -> bool:
+    try:
+        if fcntl:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(f.fileno(), flags)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def _unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(name: str, blocking: bool = True):
+    """Inter-process lock backed by `<runtime_dir>/<name>.lock`
+
+    Yields True when the lock is held, False when `blocking` is False and
+    another process (or thread) already holds it. The OS drops the lock if
+    the holder dies, so a crashed worker never leaves a stale lock behind.
+    """
+    path = os.path.join(get_runtime_dir(), f"{name}.lock")
+    with open(path, "a+") as f:
+        acquired = _lock_file(f, blocking)
+        try:
+            if acquired:
+                f.seek(0)
+                f.truncate()
+                f.write(str(os.getpid()))
+                f.flush()
+            yield acquired
+        finally:
+            if acquired:
+                _unlock_file(f)
+
+def try_file_lock(name: str) -> Optional[ExitStack]:
+    """Take `name` without blocking and return a stack that releases it on close
+
+    Returns None when the lock is held elsewhere. Lets a request claim a
+    lock and hand it over to the background task that does the work.
+    """
+    stack = ExitStack()
+    if stack.enter_context(file_lock(name, blocking=False)):
+        return stack
+    stack.close()
+    return None
+
+def _generation_path() -> str:
+    return os.path.join(get_runtime_dir(), "library.generation")
+
+def read_library_generation() -> int:
+    try:
+        with open(_generation_path()) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def bump_library_generation() -> int:
+    """Announce to every worker that the library changed; returns the new generation"""
+    with file_lock("generation"):
+        generation = read_library_generation() + 1
+        path = _generation_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(generation))
+        os.replace(tmp_path, path)
+    library_watcher.check(force=True)
+    return generation
+
+class LibraryWatcher:
+    """Per-process view of the library generation
+
+    Callbacks registered with `on_change` run (in the calling thread) the
+    first time `check` notices that another process bumped the generation.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self._callbacks: List[Callable[[int], None]] = []
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+
+    def on_change(self, callback: Callable[[int], None]):
+        self._callbacks.append(callback)
+        return callback
+
+    def check(self, force: bool = False) -> int:
+        now = time.monotonic()
+        if not force and now - self._last_check < GENERATION_CHECK_INTERVAL:
+            return self.generation
+        with self._lock:
+            self._last_check = now
+            generation = read_library_generation()
+            if generation == self.generation:
+                return generation
+            first_check = self.generation is None
+            self.generation = generation
+        if not first_check:
+            for callback in self._callbacks:
+                try:
+                    callback(generation)
+                except Exception as e:
+                    print(f"Error invalidating caches for generation {generation}: {e}")
+        return generation
+
+library_watcher = LibraryWatcher()
+
+def _play_log_path() -> str:
+    return os.path.join(get_runtime_dir(), "plays.log")
+
+def append_play(track_id: int, play_count: int):
+    """Announce a track's new play count to every worker's catalog
+
+    Records are appended with one O_APPEND write, so concurrent writers
+    never interleave. When the log grows past PLAY_LOG_MAX_BYTES it starts
+    over and the library generation is bumped, so workers that had not read
+    the end of the old log rebuild from the database instead.
+    """
+    path = _play_log_path()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, PLAY_RECORD.pack(track_id, play_count))
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if size >= PLAY_LOG_MAX_BYTES:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        open(tmp_path, "wb").close()
+        os.replace(tmp_path, path)
+        bump_library_generation()
+
+def play_log_position() -> Tuple[int, int]:
+    """(inode, size) of the play log; records past it are newer"""
+    try:
+        stat = os.stat(_play_log_path())
+    except OSError:
+        return 0, 0
+    return stat.st_ino, stat.st_size
+
+def read_plays(position: Tuple[int, int]) -> Tuple[Tuple[int, int], List[Tuple[int, int]]]:
+    """(track_id, play_count) records appended since `position`, and the new position
+
+    A log that was started over is read from its beginning; replaying
+    records is harmless because they hold absolute counts.
+    """
+    try:
+        f = open(_play_log_path(), "rb")
+    except OSError:
+        return position, []
+    with f:
+        stat = os.fstat(f.fileno())
+        inode, offset = position
+        if stat.st_ino != inode or stat.st_size < offset:
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+    # A record still being written is picked up by the next call
+    data = data[:len(data) - len(data) % PLAY_RECORD.size]
+    return (stat.st_ino, offset + len(data)), list(PLAY_RECORD.iter_unpack(data))
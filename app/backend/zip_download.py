@@ -0,0 +1,375 @@
+import hashlib
+import os
+import re
+import struct
+import time
+import zlib
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from . import crud, models
+from .duplicates import is_unchanged
+
+# Read size when copying files into the archive
+READ_SIZE = 1024 * 1024
+# Values at or above these need ZIP64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+# Bit 3: CRC and sizes follow the data; bit 11: names are UTF-8
+FLAGS = 0x0808
+# Cover files looked for next to the tracks when the album has no cover_path
+COVER_NAMES = ("cover", "folder", "front", "album")
+COVER_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Track ids per lyric query (SQLite variable limit)
+ID_BATCH_SIZE = 500
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<4sHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<4sQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<4sIQI")
+
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def safe_name(name: str, fallback: str = "untitled") -> str:
+    """Make a tag value usable as a file name on every platform"""
+    name = re.sub(r'[\x00-\x1f<>:"/\\|?*]', "_", name or "").strip(" .")
+    return name[:150] or fallback
+
+
+class ZipEntry:
+    """A file in the archive: either a file on disk or small in-memory data"""
+
+    __slots__ = ("name", "size", "mtime", "path", "data", "crc", "track_id", "offset", "zip64")
+
+    def __init__(self, name: str, size: int, mtime: float, path: Optional[str] = None,
+                 data: Optional[bytes] = None, crc: Optional[int] = None, track_id: Optional[int] = None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.path = path
+        self.data = data
+        self.crc = crc
+        self.track_id = track_id
+        self.offset = 0
+        self.zip64 = size >= ZIP64_LIMIT
+
+    @classmethod
+    def from_file(cls, name: str, path: str, stat: os.stat_result = None, **kwargs) -> "ZipEntry":
+        stat = stat or os.stat(path)
+        return cls(name, stat.st_size, stat.st_mtime, path=path, **kwargs)
+
+    @classmethod
+    def from_bytes(cls, name: str, data: bytes, mtime: float) -> "ZipEntry":
+        return cls(name, len(data), mtime, data=data, crc=zlib.crc32(data))
+
+    @property
+    def encoded_name(self) -> bytes:
+        return self.name.encode("utf-8")
+
+    def local_header_size(self) -> int:
+        return LOCAL_HEADER.size + len(self.encoded_name) + (20 if self.zip64 else 0)
+
+    def descriptor_size(self) -> int:
+        return 24 if self.zip64 else 16
+
+    def central_header_size(self) -> int:
+        extra = (16 if self.zip64 else 0) + (8 if self.offset >= ZIP64_LIMIT else 0)
+        return CENTRAL_HEADER.size + len(self.encoded_name) + (4 + extra if extra else 0)
+
+
+class ZipStream:
+    """Store-only ZIP archive generated on the fly from the source files
+
+    The layout only depends on entry names, sizes and mtimes, so the total
+    size is known before anything is read and any byte range can be
+    regenerated identically, which is what makes Range resume work. CRCs go
+    in data descriptors after each file, so a file is read once while it is
+    sent; a CRC is only computed separately when a range starts past the
+    file's data. Memory use does not depend on file sizes.
+    """
+
+    def __init__(self, entries: List[ZipEntry]):
+        self.entries = entries
+        # CRCs computed while streaming, as (track_id, size, mtime, crc), for caching
+        self.computed_crcs: List[Tuple[int, int, float, int]] = []
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset += entry.local_header_size() + entry.size + entry.descriptor_size()
+        self.central_offset = offset
+        self.central_size = sum(entry.central_header_size() for entry in entries)
+        end = offset + self.central_size
+        self.zip64 = (len(entries) >= ZIP64_COUNT_LIMIT or self.central_size >= ZIP64_LIMIT
+                      or self.central_offset >= ZIP64_LIMIT)
+        self.end_size = END_RECORD.size + (ZIP64_END_RECORD.size + ZIP64_END_LOCATOR.size if self.zip64 else 0)
+        self.size = end + self.end_size
+
+    @property
+    def etag(self) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for entry in self.entries:
+            h.update(f"{entry.name}\0{entry.size}\0{entry.mtime}\0{entry.crc if entry.data is not None else ''}\n".encode())
+        return f'"{h.hexdigest()}"'
+
+    # -- records ----------------------------------------------------------------
+
+    def _local_header(self, entry: ZipEntry) -> bytes:
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        name = entry.encoded_name
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if entry.zip64 else b""
+        return LOCAL_HEADER.pack(
+            b"PK\x03\x04", 45 if entry.zip64 else 20, FLAGS, 0, dos_time, dos_date,
+            0, 0, 0, len(name), len(extra)
+        ) + name + extra
+
+    def _descriptor(self, entry: ZipEntry) -> bytes:
+        crc = self._crc(entry)
+        if entry.zip64:
+            return struct.pack("<4sIQQ", b"PK\x07\x08", crc, entry.size, entry.size)
+        return struct.pack("<4sIII", b"PK\x07\x08", crc, entry.size, entry.size)
+
+    def _central_header(self, entry: ZipEntry) -> bytes:
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        name = entry.encoded_name
+        extra_fields = []
+        size = entry.size
+        if entry.zip64:
+            extra_fields += [entry.size, entry.size]
+            size = ZIP64_LIMIT
+        offset = entry.offset
+        if offset >= ZIP64_LIMIT:
+            extra_fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b""
+        if extra_fields:
+            extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+        needs_zip64 = bool(extra_fields)
+        return CENTRAL_HEADER.pack(
+            b"PK\x01\x02", 45 if needs_zip64 else 20, 45 if needs_zip64 else 20, FLAGS, 0,
+            dos_time, dos_date, self._crc(entry), size, size, len(name), len(extra), 0, 0, 0,
+            0o100644 << 16, offset
+        ) + name + extra
+
+    def _end_records(self) -> bytes:
+        count = len(self.entries)
+        records = b""
+        if self.zip64:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += ZIP64_END_RECORD.pack(
+                b"PK\x06\x06", ZIP64_END_RECORD.size - 12, 45, 45, 0, 0,
+                count, count, self.central_size, self.central_offset
+            )
+            records += ZIP64_END_LOCATOR.pack(b"PK\x06\x07", 0, zip64_end_offset, 1)
+            return records + END_RECORD.pack(
+                b"PK\x05\x06", 0, 0, ZIP64_COUNT_LIMIT, ZIP64_COUNT_LIMIT, ZIP64_LIMIT, ZIP64_LIMIT, 0
+            )
+        return END_RECORD.pack(b"PK\x05\x06", 0, 0, count, count, self.central_size, self.central_offset, 0)
+
+    # -- data -------------------------------------------------------------------
+
+    def _crc(self, entry: ZipEntry) -> int:
+        if entry.crc is None:
+            for _ in self._read_file(entry, 0, 0, READ_SIZE):
+                pass
+        return entry.crc
+
+    def _read_file(self, entry: ZipEntry, skip: int, limit: int, chunk_size: int) -> Iterator[bytes]:
+        """Read a whole file to compute its CRC, yielding only bytes [skip, limit)"""
+        crc = 0
+        position = 0
+        for chunk in self._read_known(entry, 0, entry.size, chunk_size):
+            crc = zlib.crc32(chunk, crc)
+            if position + len(chunk) > skip and position < limit:
+                yield chunk[max(skip - position, 0):limit - position]
+            position += len(chunk)
+        entry.crc = crc
+        if entry.track_id is not None:
+            self.computed_crcs.append((entry.track_id, entry.size, entry.mtime, crc))
+
+    def iter_bytes(self, start: int = 0, stop: Optional[int] = None,
+                   chunk_size: int = READ_SIZE) -> Iterator[bytes]:
+        """Yield archive bytes [start, stop)"""
+        stop = self.size if stop is None else stop
+
+        def clip(data: bytes, position: int) -> bytes:
+            return data[max(start - position, 0):max(stop - position, 0)]
+
+        for entry in self.entries:
+            position = entry.offset
+            end = position + entry.local_header_size() + entry.size + entry.descriptor_size()
+            if end <= start:
+                continue
+            if position >= stop:
+                return
+            header_size = entry.local_header_size()
+            if position + header_size > start:
+                yield clip(self._local_header(entry), position)
+            position += header_size
+            if position + entry.size > start and position < stop:
+                skip, limit = max(start - position, 0), min(stop - position, entry.size)
+                if entry.data is not None:
+                    yield entry.data[skip:limit]
+                elif entry.crc is None and position + entry.size + entry.descriptor_size() <= stop:
+                    # Read the whole file once; the CRC is ready for the descriptor
+                    yield from self._read_file(entry, skip, limit, chunk_size)
+                else:
+                    # Either the CRC is known, or the range ends inside this file
+                    yield from self._read_known(entry, skip, limit, chunk_size)
+            position += entry.size
+            if position < stop:
+                yield clip(self._descriptor(entry), position)
+
+        position = self.central_offset
+        for entry in self.entries:
+            record_size = entry.central_header_size()
+            if position + record_size > start and position < stop:
+                yield clip(self._central_header(entry), position)
+            position += record_size
+        if position < stop:
+            yield clip(self._end_records(), position)
+
+    def _read_known(self, entry: ZipEntry, skip: int, limit: int, chunk_size: int) -> Iterator[bytes]:
+        with open(entry.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size != entry.size:
+                raise OSError(f"{entry.path} changed while downloading")
+            f.seek(skip)
+            position = skip
+            while position < limit:
+                chunk = f.read(min(chunk_size, limit - position))
+                if not chunk:
+                    raise OSError(f"{entry.path} changed while downloading")
+                yield chunk
+                position += len(chunk)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=" range into [start, stop)
+
+    Returns None when the header should be ignored (other units or several
+    ranges, which are answered with the full archive) and raises ValueError
+    when the range can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(size - length, 0), size
+        start = int(first)
+        stop = size if last == "" else min(int(last) + 1, size)
+    except ValueError:
+        raise ValueError(f"Invalid range: {header}")
+    if start >= size or stop <= start:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return start, stop
+
+
+# -- archive contents -------------------------------------------------------------
+
+def find_cover(album: Optional[models.Album], directory: str, cache: dict) -> Optional[str]:
+    """The album's cover_path, or a cover/folder/front image next to the track"""
+    if album is not None and album.cover_path and os.path.isfile(album.cover_path):
+        return album.cover_path
+    if directory not in cache:
+        cache[directory] = None
+        try:
+            files = {name.lower(): name for name in os.listdir(directory)}
+        except OSError:
+            files = {}
+        for base in COVER_NAMES:
+            for ext in COVER_EXTENSIONS:
+                if base + ext in files:
+                    cache[directory] = os.path.join(directory, files[base + ext])
+                    break
+            if cache[directory]:
+                break
+    return cache[directory]
+
+
+def _unique(name: str, used: set) -> str:
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 2
+    while candidate.lower() in used:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def build_archive(folder: str, tracks: List[models.Track], db: Session,
+                  with_artist: bool = False, single_cover: bool = False) -> ZipStream:
+    """Lay out tracks (in order), their lyrics and cover art under `folder`
+
+    Missing files are skipped. With `single_cover` one cover.<ext> is added
+    (albums); otherwise every distinct cover goes to covers/<album>.<ext>.
+    """
+    folder = safe_name(folder, "music")
+    lyrics = {}
+    track_ids = [track.id for track in tracks]
+    for i in range(0, len(track_ids), ID_BATCH_SIZE):
+        lyrics.update(crud.get_lyrics(db, track_ids[i:i + ID_BATCH_SIZE]))
+
+    entries, used, covers, cover_cache = [], set(), {}, {}
+    width = max(2, len(str(len(tracks))))
+    number = 0
+    for track in tracks:
+        try:
+            stat = os.stat(track.file_path)
+        except OSError:
+            continue
+        number += 1
+        title = track.title
+        if with_artist and track.artist:
+            title = f"{track.artist.name} - {title}"
+        stem = f"{number:0{width}d} - {safe_name(title)}"
+        ext = os.path.splitext(track.file_path)[1].lower()
+        # Reuse the CRC cached by an earlier download if the file is unchanged
+        crc = track.crc32 if track.crc32 is not None and is_unchanged(track, stat) else None
+        entries.append(ZipEntry.from_file(
+            f"{folder}/{_unique(stem + ext, used)}", track.file_path, stat, crc=crc, track_id=track.id
+        ))
+        lyric = lyrics.get(track.id)
+        if lyric is not None and lyric.content:
+            entries.append(ZipEntry.from_bytes(
+                f"{folder}/{_unique(stem + '.lrc', used)}", lyric.content.encode("utf-8"), stat.st_mtime
+            ))
+        cover = find_cover(track.album, os.path.dirname(track.file_path), cover_cache)
+        if cover and cover not in covers and not (single_cover and covers):
+            cover_ext = os.path.splitext(cover)[1].lower()
+            if single_cover:
+                name = f"cover{cover_ext}"
+            else:
+                name = f"covers/{safe_name(track.album.title if track.album else '', 'cover')}{cover_ext}"
+            covers[cover] = f"{folder}/{_unique(name, used)}"
+
+    for path, name in covers.items():
+        try:
+            entries.append(ZipEntry.from_file(name, path))
+        except OSError:
+            continue
+    return ZipStream(entries)
+
+
+def save_computed_crcs(db: Session, archive: ZipStream):
+    """Cache CRCs computed while streaming, unless the file changed since the scan"""
+    for track_id, size, mtime, crc in archive.computed_crcs:
+        db.query(models.Track).filter(
+            models.Track.id == track_id,
+            models.Track.file_size == size,
+            models.Track.file_mtime == mtime,
+        ).update({models.Track.crc32: crc}, synchronize_session=False)
+    db.commit()